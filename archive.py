@@ -0,0 +1,261 @@
+"""Move old history out of the hot collections.
+
+Completed tasks and Pomodoro sessions older than ARCHIVE_AFTER_DAYS are moved
+in batches into `tasks_archive` and `pomodoro_sessions_archive`. Each archive
+document is a bucket holding one user's share of a batch as zlib-compressed
+BSON, plus per-day totals so stats can be rebuilt without unpacking it:
+
+    {_id: <_id of the bucket's first document>, user_id, start, end, count,
+     days: [{day, completed_tasks | total_sessions, total_focus}], data: <bytes>}
+
+Readers that want the whole history (/completed_tasks, /export, the stats
+backfill) read both tiers. Archiving runs every ARCHIVE_INTERVAL_SECONDS in
+the bot, or once with:
+
+    python archive.py run
+"""
+import asyncio
+import logging
+import os
+import sys
+import zlib
+from datetime import datetime, timedelta
+
+import bson
+from pymongo.errors import BulkWriteError
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from cluster import partition_filter
+from db import pomodoro_collection, session_archive_collection, task_archive_collection, tasks_collection
+from metrics import Counter
+from pagination import PAGE_SIZE, format_completed, page_cache
+from stats import day_of
+
+logger = logging.getLogger(__name__)
+
+# 0 turns archiving off.
+ARCHIVE_AFTER = timedelta(days=int(os.getenv("ARCHIVE_AFTER_DAYS", "180")))
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL_SECONDS", "3600"))
+ARCHIVE_BATCH = 1000
+DUPLICATE_KEY = 11000
+
+ARCHIVED = Counter("archived_documents_total", "Documents moved to the archive.", ["kind"])
+
+
+def task_days(tasks: list) -> list:
+    days = {}
+    for task in tasks:
+        day = day_of(date_of(task, TIERS["tasks"]))
+        days[day] = days.get(day, 0) + 1
+    return [{"day": day, "completed_tasks": count} for day, count in sorted(days.items())]
+
+
+def session_days(sessions: list) -> list:
+    days = {}
+    for session in sessions:
+        totals = days.setdefault(day_of(session["start_time"]), {"total_sessions": 0, "total_focus": 0})
+        completed = session.get("sessions_completed") or 0
+        totals["total_sessions"] += completed
+        totals["total_focus"] += session.get("focus_minutes", completed * (session.get("work_duration") or 0))
+    return [{"day": day, **totals} for day, totals in sorted(days.items())]
+
+
+# What gets archived from where, keyed by the kind used in metrics and logs.
+TIERS = {
+    "tasks": {
+        "hot": tasks_collection,
+        "cold": task_archive_collection,
+        "match": {"status": "completed"},
+        "date": "completed_at",
+        # Tasks completed before completed_at was recorded go by their due
+        # date, as in the stats backfill.
+        "fallback": "due_date",
+        "days": task_days,
+    },
+    "sessions": {
+        "hot": pomodoro_collection,
+        "cold": session_archive_collection,
+        "match": {},
+        "date": "start_time",
+        "days": session_days,
+    },
+}
+
+
+def date_of(doc: dict, tier: dict) -> datetime:
+    """The date a document is archived by."""
+    return doc.get(tier["date"]) or doc[tier.get("fallback", tier["date"])]
+
+
+def archive_query(tier: dict, cutoff: datetime) -> dict:
+    if "fallback" not in tier:
+        return {**tier["match"], tier["date"]: {"$lt": cutoff}}
+    return {**tier["match"], "$or": [
+        {tier["date"]: {"$lt": cutoff}},
+        {tier["date"]: {"$exists": False}, tier["fallback"]: {"$lt": cutoff}},
+    ]}
+
+
+def pack(docs: list, tier: dict) -> dict:
+    """Build the archive bucket of one user's documents, oldest first."""
+    dates = [date_of(doc, tier) for doc in docs]
+    return {
+        "_id": docs[0]["_id"],
+        "user_id": docs[0]["user_id"],
+        "start": min(dates),
+        "end": max(dates),
+        "count": len(docs),
+        "days": tier["days"](docs),
+        "data": zlib.compress(b"".join(bson.encode(doc) for doc in docs)),
+    }
+
+
+def unpack(bucket: dict) -> list:
+    return bson.decode_all(zlib.decompress(bucket["data"]))
+
+
+async def archive_batch(kind: str, cutoff: datetime, partitions=None) -> int:
+    """Archive up to ARCHIVE_BATCH documents older than `cutoff`; returns how many.
+
+    Bucket ids are the ids of their first document, so if a batch is retried
+    after a crash between the insert and the delete, the buckets already
+    written are rejected as duplicates instead of being stored twice. Only
+    the documents actually stored in a bucket are deleted from the hot tier;
+    the rest of a rejected bucket is archived by a later batch.
+    """
+    tier = TIERS[kind]
+    query = archive_query(tier, cutoff)
+    if partitions is not None:
+        query.update(partition_filter(partitions))
+    # _id breaks ties, so a retried batch selects the same documents.
+    docs = await tier["hot"].find(query).sort([(tier["date"], 1), ("_id", 1)]).limit(ARCHIVE_BATCH).to_list(None)
+    if not docs:
+        return 0
+
+    by_user = {}
+    for doc in docs:
+        by_user.setdefault(doc["user_id"], []).append(doc)
+    user_docs = list(by_user.values())
+    buckets = await asyncio.to_thread(lambda: [pack(group, tier) for group in user_docs])
+    rejected = []
+    try:
+        await tier["cold"].insert_many(buckets, ordered=False)
+    except BulkWriteError as e:
+        if any(error["code"] != DUPLICATE_KEY for error in e.details["writeErrors"]):
+            raise
+        rejected = [error["index"] for error in e.details["writeErrors"]]
+
+    archived = [doc["_id"] for index, group in enumerate(user_docs) if index not in rejected for doc in group]
+    if rejected:
+        stored = tier["cold"].find({"_id": {"$in": [buckets[index]["_id"] for index in rejected]}})
+        async for bucket in stored:
+            archived += [doc["_id"] for doc in unpack(bucket)]
+    await tier["hot"].delete_many({"_id": {"$in": archived}})
+
+    if kind == "tasks":
+        for user_id in by_user:
+            page_cache.bump(user_id)
+    ARCHIVED.inc(len(archived), kind=kind)
+    return len(archived)
+
+
+async def archive_all(partitions=None) -> dict:
+    """Archive everything older than ARCHIVE_AFTER; returns the count per kind."""
+    cutoff = day_of(datetime.utcnow()) - ARCHIVE_AFTER
+    counts = {}
+    for kind in TIERS:
+        counts[kind] = 0
+        while True:
+            archived = await archive_batch(kind, cutoff, partitions)
+            counts[kind] += archived
+            if archived < ARCHIVE_BATCH:
+                break
+    return counts
+
+
+async def iter_archived(kind: str, user_id: int, since: datetime = None):
+    """Yield a user's archived documents, newest bucket first.
+
+    With `since`, only buckets reaching past it are read; documents older
+    than `since` in those buckets are still yielded.
+    """
+    query = {"user_id": user_id}
+    if since:
+        query["end"] = {"$gte": since}
+    cursor = TIERS[kind]["cold"].find(query).sort([("end", -1), ("_id", -1)])
+    async for bucket in cursor:
+        for doc in reversed(unpack(bucket)):
+            yield doc
+
+
+async def render_archive_page(user_id: int, page: int = 0):
+    """Return (text, reply_markup) for a page of archived tasks, newest first, or None."""
+    buckets = await task_archive_collection.find(
+        {"user_id": user_id}, {"count": 1}
+    ).sort([("end", -1), ("_id", -1)]).to_list(None)
+    total = sum(bucket["count"] for bucket in buckets)
+    skip = page * PAGE_SIZE
+    if skip >= total:
+        return None
+
+    tasks = []
+    for bucket in buckets:
+        if skip >= bucket["count"]:
+            skip -= bucket["count"]
+            continue
+        bucket = await task_archive_collection.find_one({"_id": bucket["_id"]}, {"data": 1})
+        tasks += list(reversed(unpack(bucket)))[skip:skip + PAGE_SIZE - len(tasks)]
+        skip = 0
+        if len(tasks) >= PAGE_SIZE:
+            break
+
+    text = "🗄 Archived tasks:\n" + "\n".join(format_completed(task) for task in tasks)
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("◀ Newer", callback_data=f"ar:{page - 1}"))
+    if total > (page + 1) * PAGE_SIZE:
+        navigation.append(InlineKeyboardButton("Older ▶", callback_data=f"ar:{page + 1}"))
+    return text, InlineKeyboardMarkup([navigation]) if navigation else None
+
+
+class Archiver:
+    """Run `archive_all` every ARCHIVE_INTERVAL for the users this worker owns."""
+
+    def __init__(self, partitions=lambda: None, interval: float = ARCHIVE_INTERVAL):
+        self.partitions = partitions
+        self.interval = interval
+        self._runner = None
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            partitions = self.partitions()
+            if partitions is not None and not partitions:
+                continue
+            try:
+                counts = await archive_all(partitions)
+            except Exception:
+                logger.exception("Archiving failed")
+                continue
+            if any(counts.values()):
+                logger.info("Archived %d tasks and %d Pomodoro sessions", counts["tasks"], counts["sessions"])
+
+    def start(self) -> None:
+        if ARCHIVE_AFTER:
+            self._runner = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._runner:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["run"] or not ARCHIVE_AFTER:
+        sys.exit("usage: python archive.py run  (with ARCHIVE_AFTER_DAYS > 0)")
+    logging.basicConfig(level=logging.INFO)
+    print(asyncio.run(archive_all()))
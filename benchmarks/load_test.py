@@ -0,0 +1,259 @@
+"""Offline load test of the real bot handlers.
+
+Builds the Application through `bot.build_application` and drives it with
+synthetic updates from N simulated users, each of which runs:
+
+    /start, /addtask (x --tasks-per-user), /tasks, /done + a done_ button,
+    /pomodoro + a task_ button + 1 session of 1 minute, then task_done_yes
+
+Outbound Bot API calls go to an in-process fake that records them instead of
+reaching Telegram, Mongo is a scratch database on a local mongod (MONGO_URI,
+default mongodb://localhost:27017) and Pomodoro minutes are shrunk to
+--minute-seconds, so the whole run needs no network:
+
+    python benchmarks/load_test.py --users 200 --concurrency 50
+
+Reports throughput, p50/p95/p99 latency and Mongo commands per update for
+every step, plus the Bot API calls the run made.
+"""
+import argparse
+import asyncio
+import contextvars
+import itertools
+import json
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+from pymongo import monitoring
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import BaseRequest
+
+LOAD_TEST_DB = "telegram_bot_load_test"
+FAKE_TOKEN = "123456:load-test"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Tomato", "username": "tomato_load_test_bot"}
+
+update_ids = itertools.count(1)
+
+# The step an update belongs to, so Mongo commands can be attributed to it.
+current_step = contextvars.ContextVar("current_step", default="background")
+
+
+class CommandCounter(monitoring.CommandListener):
+    """Count the Mongo commands issued while each step runs."""
+
+    def __init__(self):
+        self.commands = Counter()
+
+    def started(self, event):
+        self.commands[current_step.get()] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+class FakeBotAPI(BaseRequest):
+    """Answer Bot API requests in process and remember what was sent to each chat."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.messages = defaultdict(list)
+        self._message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] += 1
+
+        if endpoint == "getMe":
+            result = BOT_USER
+        elif endpoint in ("sendMessage", "editMessageText"):
+            chat_id = int(params["chat_id"])
+            result = {
+                "message_id": params.get("message_id") or next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+            if "reply_markup" in params:
+                result["reply_markup"] = params["reply_markup"]
+            self.messages[chat_id].append(result)
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    def find_button(self, chat_id: int, prefix: str):
+        """Return (message, callback_data) of the newest button starting with `prefix`."""
+        for message in reversed(self.messages[chat_id]):
+            for row in message.get("reply_markup", {}).get("inline_keyboard", []):
+                for button in row:
+                    if button.get("callback_data", "").startswith(prefix):
+                        return message, button["callback_data"]
+        return None
+
+
+class SimulatedUser:
+    def __init__(self, user_id: int, application: Application, api: FakeBotAPI, latencies: dict):
+        self.user_id = user_id
+        self.application = application
+        self.api = api
+        self.latencies = latencies
+        self.user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+    async def _process(self, step: str, data: dict):
+        update = Update.de_json({"update_id": next(update_ids), **data}, self.application.bot)
+        current_step.set(step)
+        started = time.perf_counter()
+        await self.application.process_update(update)
+        self.latencies[step].append(time.perf_counter() - started)
+        current_step.set("background")
+
+    async def send(self, step: str, text: str):
+        message = {
+            "message_id": next(update_ids),
+            "date": int(time.time()),
+            "chat": {"id": self.user_id, "type": "private"},
+            "from": self.user,
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        await self._process(step, {"message": message})
+
+    async def click(self, step: str, prefix: str, timeout: float = 0):
+        deadline = time.monotonic() + timeout
+        found = self.api.find_button(self.user_id, prefix)
+        while found is None and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+            found = self.api.find_button(self.user_id, prefix)
+        if found is None:
+            raise RuntimeError(f"user {self.user_id} never got a {prefix!r} button")
+        message, callback_data = found
+        await self._process(step, {"callback_query": {
+            "id": str(next(update_ids)),
+            "from": self.user,
+            "chat_instance": str(self.user_id),
+            "message": message,
+            "data": callback_data,
+        }})
+
+    async def run(self, tasks_per_user: int, pomodoro_timeout: float):
+        await self.send("/start", "/start")
+        # Far enough ahead that no reminder fires during the run.
+        due_date = (datetime.utcnow() + timedelta(days=30)).strftime("%Y-%m-%d")
+        for n in range(tasks_per_user):
+            await self.send("/addtask", "/addtask")
+            await self.send("addtask: title", f"Task {n}")
+            await self.send("addtask: description", f"Load test task {n}")
+            await self.send("addtask: due date", due_date)
+            await self.send("addtask: repeat", "/skip")
+        await self.send("/tasks", "/tasks")
+        await self.send("/done", "/done")
+        await self.click("done_ button", "done_")
+
+        await self.send("/pomodoro", "/pomodoro")
+        await self.click("task_ button", "task_")
+        await self.send("pomodoro: sessions", "1")
+        await self.send("pomodoro: work time", "1")
+        await self.send("pomodoro: break time", "1")
+        await self.click("task_done_yes", "task_done_yes", timeout=pomodoro_timeout)
+
+
+def percentile(values: list, q: float) -> float:
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run(args) -> None:
+    counter = CommandCounter()
+    monitoring.register(counter)
+    # The Mongo client is created when db.py is imported, after the listener.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import bot
+    from db import client, db
+    from outbound import OutboundLimiter
+
+    api = FakeBotAPI()
+    builder = Application.builder().token(FAKE_TOKEN).request(api).get_updates_request(FakeBotAPI())
+    rate_limiter = None if args.rate_limit else OutboundLimiter(
+        overall_rate=1e9, private_chat_rate=1e9, group_chat_rate=1e9
+    )
+    application = bot.build_application(builder, rate_limiter)
+
+    await client.drop_database(db.name)
+    latencies = defaultdict(list)
+    users = [SimulatedUser(user_id, application, api, latencies) for user_id in range(1, args.users + 1)]
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def run_user(user):
+        async with semaphore:
+            await user.run(args.tasks_per_user, args.pomodoro_timeout)
+
+    async with application:
+        await bot.on_startup(application)
+        await application.start()
+        started = time.perf_counter()
+        await asyncio.gather(*(run_user(user) for user in users))
+        elapsed = time.perf_counter() - started
+        await application.stop()
+        commands = dict(counter.commands)
+        await client.drop_database(db.name)
+        await bot.on_shutdown(application)
+
+    total_updates = sum(len(values) for values in latencies.values())
+    print(f"{args.users} users, {total_updates} updates in {elapsed:.1f}s: {total_updates / elapsed:.1f} updates/s\n")
+    print(f"{'step':22} {'updates':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'mongo/update':>13}")
+    for step, values in latencies.items():
+        values.sort()
+        print(
+            f"{step:22} {len(values):8} "
+            + " ".join(f"{percentile(values, q) * 1000:8.1f}" for q in (0.5, 0.95, 0.99))
+            + f" {commands.get(step, 0) / len(values):13.1f}"
+        )
+    print(f"\nmongo commands: {sum(commands.values())} "
+          f"({sum(commands.values()) / total_updates:.1f}/update, "
+          f"{commands.get('background', 0)} from schedulers and startup)")
+    print("bot api calls: " + ", ".join(f"{endpoint} {count}" for endpoint, count in api.calls.most_common()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--uri", default=os.getenv("MONGO_URI", "mongodb://localhost:27017"))
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--tasks-per-user", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=50, help="users active at once")
+    parser.add_argument("--minute-seconds", type=float, default=0.05, help="length of a Pomodoro minute")
+    parser.add_argument("--pomodoro-timeout", type=float, default=30, help="seconds to wait for a session to end")
+    parser.add_argument("--rate-limit", action="store_true", help="keep Telegram's outbound rate limits")
+    args = parser.parse_args()
+    if args.tasks_per_user < 2:
+        parser.error("--tasks-per-user must be at least 2: one is marked done, one gets a Pomodoro")
+
+    # Read by db.py, bot.py and timers.py at import time.
+    os.environ["MONGO_URI"] = args.uri
+    os.environ["MONGO_DB"] = LOAD_TEST_DB
+    os.environ["BOT_TOKEN"] = FAKE_TOKEN
+    os.environ["POMODORO_MINUTE_SECONDS"] = str(args.minute_seconds)
+    os.environ.pop("CLUSTER", None)
+    os.environ.pop("WEBHOOK_URL", None)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
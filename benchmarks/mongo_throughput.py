@@ -0,0 +1,125 @@
+"""Update throughput of the task handlers with a blocking vs an async Mongo driver.
+
+Runs against a local mongod (MONGO_URI, default mongodb://localhost:27017) and
+uses a scratch database, so it never touches the bot's data:
+
+    python benchmarks/mongo_throughput.py --users 200 --updates 5000 --concurrency 64
+
+"before" replays the queries of `/tasks` through the synchronous MongoClient
+inside the event loop, the way the handlers used to. "after" issues the same
+queries through AsyncMongoClient.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from pymongo import AsyncMongoClient, MongoClient
+
+BENCH_DB = "telegram_bot_bench"
+
+
+def seed(uri, users, tasks_per_user):
+    client = MongoClient(uri)
+    db = client[BENCH_DB]
+    db.tasks.drop()
+    db.user_settings.drop()
+    db.tasks.create_index([("user_id", 1), ("due_date", 1)])
+    db.user_settings.create_index("user_id", unique=True)
+    now = datetime.utcnow()
+    db.user_settings.insert_many(
+        [{"user_id": user_id, "notifications": True} for user_id in range(users)]
+    )
+    db.tasks.insert_many([
+        {
+            "user_id": user_id,
+            "title": f"Task {n}",
+            "description": "",
+            "due_date": now + timedelta(days=n),
+            "status": "pending",
+            "created_at": now,
+        }
+        for user_id in range(users)
+        for n in range(tasks_per_user)
+    ])
+    client.close()
+
+
+def list_tasks_sync(db, user_id):
+    db.user_settings.find_one({"user_id": user_id})
+    if db.tasks.count_documents({"user_id": user_id, "status": "pending"}) == 0:
+        return 0
+    return len(list(db.tasks.find({"user_id": user_id, "status": "pending"})))
+
+
+async def list_tasks_async(db, user_id):
+    await db.user_settings.find_one({"user_id": user_id})
+    if await db.tasks.count_documents({"user_id": user_id, "status": "pending"}) == 0:
+        return 0
+    return len(await db.tasks.find({"user_id": user_id, "status": "pending"}).to_list(None))
+
+
+async def drive(handler, users, updates, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one_update():
+        async with semaphore:
+            started = time.perf_counter()
+            await handler(random.randrange(users))
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one_update() for _ in range(updates)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "updates/s": updates / elapsed,
+        "p50 ms": statistics.median(latencies) * 1000,
+        "p99 ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+async def run(uri, users, updates, concurrency):
+    sync_client = MongoClient(uri, maxPoolSize=concurrency)
+    sync_db = sync_client[BENCH_DB]
+
+    async def before(user_id):
+        list_tasks_sync(sync_db, user_id)
+
+    async_client = AsyncMongoClient(uri, maxPoolSize=concurrency)
+    async_db = async_client[BENCH_DB]
+
+    async def after(user_id):
+        await list_tasks_async(async_db, user_id)
+
+    results = {
+        "before (MongoClient)": await drive(before, users, updates, concurrency),
+        "after (AsyncMongoClient)": await drive(after, users, updates, concurrency),
+    }
+    sync_client.close()
+    await async_client.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--uri", default=os.getenv("MONGO_URI", "mongodb://localhost:27017"))
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--tasks-per-user", type=int, default=20)
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    args = parser.parse_args()
+
+    seed(args.uri, args.users, args.tasks_per_user)
+    results = asyncio.run(run(args.uri, args.users, args.updates, args.concurrency))
+    for name, result in results.items():
+        print(f"{name:26} " + "  ".join(f"{key}: {value:9.1f}" for key, value in result.items()))
+    MongoClient(args.uri).drop_database(BENCH_DB)
+
+
+if __name__ == "__main__":
+    main()
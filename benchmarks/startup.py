@@ -0,0 +1,122 @@
+"""Cold start cost of the bot: import time and time to the first reply.
+
+Every run starts a fresh interpreter that imports bot.py, builds the
+application against the fake Bot API from load_test.py, runs the startup hook
+and sends /start as soon as the application accepts updates. Mongo is a
+scratch database on a local mongod (MONGO_URI, default mongodb://localhost:27017):
+
+    python benchmarks/startup.py --runs 10
+
+Prints the median and worst import time, time until updates are accepted and
+time from process spawn to the reply to /start, plus the slowest imports of
+one run (from `python -X importtime`).
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS)
+STARTUP_DB = "telegram_bot_startup"
+
+
+async def child() -> dict:
+    started = time.perf_counter()
+    sys.path[:0] = [ROOT, BENCHMARKS]
+    import bot
+    from load_test import FAKE_TOKEN, FakeBotAPI, SimulatedUser
+    from telegram.ext import Application
+    imported = time.perf_counter()
+
+    api = FakeBotAPI()
+    builder = Application.builder().token(FAKE_TOKEN).request(api).get_updates_request(FakeBotAPI())
+    application = bot.build_application(builder)
+    async with application:
+        await bot.on_startup(application)
+        await application.start()
+        accepting = time.perf_counter()
+        await SimulatedUser(1, application, api, {"/start": []}).send("/start", "/start")
+        replied = time.time()
+        await application.stop()
+        warm_up = application.bot_data.get("warm_up")
+        if warm_up:
+            await warm_up
+        await bot.on_shutdown(application)
+    return {
+        "imports": imported - started,
+        "accepting": accepting - started,
+        "replied_at": replied,
+    }
+
+
+def run_child(env: dict) -> dict:
+    spawned = time.time()
+    output = subprocess.run(
+        [sys.executable, __file__, "--child"], env=env, check=True, capture_output=True, text=True
+    ).stdout
+    timings = json.loads(output.strip().splitlines()[-1])
+    timings["first_response"] = timings.pop("replied_at") - spawned
+    return timings
+
+
+def slowest_imports(env: dict, count: int) -> list:
+    """(cumulative seconds, module) of the slowest top-level imports of bot.py."""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import bot"],
+        env=env, cwd=ROOT, check=True, capture_output=True, text=True,
+    ).stderr
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # Only direct imports of bot.py, which are indented one level.
+        if not name.startswith("   ") or name.startswith("    "):
+            continue
+        imports.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--uri", default=os.getenv("MONGO_URI", "mongodb://localhost:27017"))
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=10, help="slowest imports to list")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(asyncio.run(child())))
+        return
+
+    env = {
+        **os.environ,
+        "MONGO_URI": args.uri,
+        "MONGO_DB": STARTUP_DB,
+        "BOT_TOKEN": "123456:startup",
+        "METRICS_PORT": "0",
+    }
+    env.pop("CLUSTER", None)
+    env.pop("WEBHOOK_URL", None)
+
+    runs = [run_child(env) for _ in range(args.runs)]
+    print(f"{'phase':16} {'median ms':>10} {'max ms':>10}")
+    for phase in ("imports", "accepting", "first_response"):
+        values = [run[phase] * 1000 for run in runs]
+        print(f"{phase:16} {statistics.median(values):10.1f} {max(values):10.1f}")
+
+    print("\nslowest imports of bot.py:")
+    for seconds, name in slowest_imports(env, args.top):
+        print(f"  {seconds * 1000:8.1f} ms  {name}")
+
+    from pymongo import MongoClient
+    MongoClient(args.uri).drop_database(STARTUP_DB)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,9 @@
+import time
+STARTED = time.perf_counter()
+
 import logging
 import asyncio
-from datetime import datetime, timedelta
+from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
@@ -11,23 +14,48 @@ from telegram.ext import (
     CallbackContext,
     ConversationHandler,
 )
-from pymongo import MongoClient
 from bson.objectid import ObjectId
-from aiogram import Bot
-
-import time
-import requests
-import threading
 
+from functools import partial
 
-from bson import ObjectId
-from telegram import InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.ext import ConversationHandler
 from telegram import ReplyKeyboardMarkup
+from telegram.error import TelegramError
 
 import os
+import signal
+import tempfile
 from dotenv import load_dotenv
-from pymongo import MongoClient
+
+from pymongo import ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from db import (
+    init_db,
+    ping_db,
+    close_db,
+    users_collection,
+    tasks_collection,
+    pomodoro_collection,
+    settings_collection,
+    stats_collection,
+    timers_collection,
+)
+from cluster import CLUSTER, WORKER_ID, PartitionManager, follow_changes
+from scheduler import ReminderScheduler
+from outbound import OutboundLimiter, BULK
+from timers import PomodoroTimers, DONE
+from cache import TTLCache
+from stats import stats_buffer, update_stats, read_stats
+from ingest import WEBHOOK_URL, PerUserUpdateProcessor, webhook_kwargs
+from pagination import WATCH_TASKS, page_cache, render_page, decode_cursor, fetch_selection_page, render_selection
+from metrics import METRICS_PORT, Gauge, MetricsServer, instrument_handlers
+from persistence import MongoPersistence
+from search import MAX_QUERY, render_search
+from transfer import MAX_IMPORT_BYTES, export_tasks, file_format, import_tasks
+from archive import DUPLICATE_KEY, Archiver, render_archive_page
+from broadcast import BroadcastRunner, cancel_job, create_job, is_admin, latest_job, progress_text
+from report import PERIODS, build_report, report_cache, shutdown_chart_pool
+from recurrence import RECURRENCE_HELP, describe, format_rule, next_occurrence, parse_recurrence
 
 load_dotenv()
 
@@ -37,68 +65,85 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# MONGO DB SETUP
-MONGO_URI = os.getenv("MONGO_URI")
 TOKEN = os.getenv("BOT_TOKEN")
-DB_NAME = "telegram_bot"
 
-# COLLECTIONS
-COLLECTIONS = {
-    "users": "users",
-    "tasks": "tasks",
-    "pomodoro_sessions": "pomodoro_sessions",
-    "user_settings": "user_settings",
-    "statistics": "statistics",
-}
-
-client = MongoClient(MONGO_URI)
-db = client[DB_NAME]
-
-users_collection = db[COLLECTIONS["users"]]
-tasks_collection = db[COLLECTIONS["tasks"]]
-pomodoro_collection = db[COLLECTIONS["pomodoro_sessions"]]
-settings_collection = db[COLLECTIONS["user_settings"]]
-stats_collection = db[COLLECTIONS["statistics"]]
-
-bot = Bot(token=TOKEN)
+STARTUP_SECONDS = Gauge("bot_startup_seconds", "Time spent in each startup phase.", ["phase"])
 
 # CONVVERSATION STATES
 (
     TITLE, DESCRIPTION, DUE_DATE,
     NUM_SESSIONS, WORK_TIME, BREAK_TIME,
     TASK_DONE, SETTING_VALUE,
-    TASK_SELECTED, SESSION_SETUP
-) = range(10)
+    TASK_SELECTED, SESSION_SETUP,
+    IMPORT_FILE, RECURRENCE,
+    SELECTING, RESCHEDULE
+) = range(14)
 
-# Global dictionary for active timers
-active_timers = {}
+# Active Pomodoro sessions, persisted in pomodoro_timers and keyed by user_id
+pomodoro_timers = PomodoroTimers()
+active_timers = pomodoro_timers.sessions
 
-def init_db():
-    tasks_collection.create_index([("user_id", 1), ("due_date", 1)])
-    pomodoro_collection.create_index([("user_id", 1), ("start_time", -1)])
-    settings_collection.create_index("user_id", unique=True)
-    stats_collection.create_index("user_id", unique=True)
-
-init_db()
+# Per-user settings and profiles; writers below update them write-through
+settings_cache = TTLCache("user_settings", ttl=int(os.getenv("USER_CACHE_TTL", "60")))
+profile_cache = TTLCache("users", ttl=int(os.getenv("USER_CACHE_TTL", "60")))
 
 # BASIC FUNCTIONS
 async def get_user_settings(user_id: int) -> dict:
-    settings = settings_collection.find_one({"user_id": user_id})
-    if not settings:
-        default_settings = {
-            "user_id": user_id,
-            "notifications": True
-        }
-        settings_collection.insert_one(default_settings)
-        return default_settings
+    settings = settings_cache.get(user_id)
+    if settings is None:
+        settings = await settings_collection.find_one_and_update(
+            {"user_id": user_id},
+            {"$setOnInsert": {"notifications": True}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        settings_cache.set(user_id, settings)
     return settings
 
-async def update_stats(user_id: int, field: str, value: int):
-    stats_collection.update_one(
-        {"user_id": user_id},
-        {"$inc": {field: value}},
-        upsert=True
+def tasks_changed(user_id: int) -> None:
+    """Drop what was cached from a user's tasks; call after every write to them."""
+    page_cache.bump(user_id)
+    report_cache.bump(user_id)
+
+async def register_user(user) -> None:
+    """Create or refresh the user's profile and statistics records."""
+    profile = {
+        "user_id": user.id,
+        "username": user.username,
+        "first_name": user.first_name,
+        "last_name": user.last_name,
+    }
+    cached = profile_cache.get(user.id)
+    if cached and all(cached.get(key) == value for key, value in profile.items()):
+        # A broadcast may have marked the user blocked since the profile was
+        # cached; this matches nothing unless it did.
+        await users_collection.update_one(
+            {"user_id": user.id, "blocked": {"$exists": True}}, {"$unset": {"blocked": ""}}
+        )
+        return
+
+    now = datetime.utcnow()
+    profile, _ = await asyncio.gather(
+        users_collection.find_one_and_update(
+            {"user_id": user.id},
+            # Talking to the bot again undoes a block recorded by a broadcast.
+            {"$set": profile, "$setOnInsert": {"joined_at": now}, "$unset": {"blocked": ""}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        ),
+        stats_collection.update_one(
+            {"user_id": user.id},
+            {"$setOnInsert": {
+                "total_sessions": 0,
+                "total_focus": 0,
+                "completed_tasks": 0,
+                "daily_sessions": 0,
+                "last_updated": now
+            }},
+            upsert=True
+        ),
     )
+    profile_cache.set(user.id, profile)
 
 async def cancel(update: Update, context: CallbackContext) -> int:
     """Cancel the current conversation."""
@@ -108,32 +153,16 @@ async def cancel(update: Update, context: CallbackContext) -> int:
 
 async def start(update: Update, context: CallbackContext) -> None:
     user = update.message.from_user
-    if not users_collection.find_one({"user_id": user.id}):
-        users_collection.insert_one({
-            "user_id": user.id,
-            "username": user.username,
-            "first_name": user.first_name,
-            "last_name": user.last_name,
-            "joined_at": datetime.utcnow(),
-        })
-    
-    await get_user_settings(user.id)
-    if not stats_collection.find_one({"user_id": user.id}):
-        stats_collection.insert_one({
-            "user_id": user.id,
-            "total_sessions": 0,
-            "total_focus": 0,
-            "completed_tasks": 0,
-            "daily_sessions": 0,
-            "last_updated": datetime.utcnow()
-        })
+    await asyncio.gather(register_user(user), get_user_settings(user.id))
 
     # BUTTONS
     keyboard = [
         ["/addtask", "/tasks"],
         ["/edit_task", "/done"],
-        ["/completed_tasks", "/stats"],
+        ["/completed_tasks", "/stats", "/report"],
         ["/settings", "/pomodoro"],
+        ["/search", "/select"],
+        ["/import", "/export"],
         ["/stop"]
     ]
 
@@ -168,39 +197,69 @@ async def skip_description(update: Update, context: CallbackContext) -> int:
 
 async def task_due_date(update: Update, context: CallbackContext) -> int:
     try:
-        due_date = datetime.strptime(update.message.text, "%Y-%m-%d")
-        task = {
-            "user_id": update.message.from_user.id,
-            "title": context.user_data["title"],
-            "description": context.user_data["description"],
-            "due_date": due_date,
-            "status": "pending",
-            "created_at": datetime.utcnow()
-        }
-        tasks_collection.insert_one(task)
-        await update.message.reply_text("✅ Task added!")
+        context.user_data["due_date"] = datetime.strptime(update.message.text, "%Y-%m-%d")
     except ValueError:
         await update.message.reply_text("❌ Invalid date format!")
         return DUE_DATE
+    await update.message.reply_text(f"🔁 Repeat? ({RECURRENCE_HELP}) or /skip:")
+    return RECURRENCE
+
+async def task_recurrence(update: Update, context: CallbackContext) -> int:
+    try:
+        rule = parse_recurrence(update.message.text)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}. Try {RECURRENCE_HELP}, or /skip.")
+        return RECURRENCE
+    return await save_task(update, context, format_rule(rule))
+
+async def skip_recurrence(update: Update, context: CallbackContext) -> int:
+    return await save_task(update, context, None)
+
+async def save_task(update: Update, context: CallbackContext, recurrence) -> int:
+    task = {
+        "user_id": update.message.from_user.id,
+        "title": context.user_data["title"],
+        "description": context.user_data["description"],
+        "due_date": context.user_data["due_date"],
+        "status": "pending",
+        "created_at": datetime.utcnow()
+    }
+    if recurrence:
+        task["recurrence"] = recurrence
+    await tasks_collection.insert_one(task)
+    tasks_changed(task["user_id"])
+    reminder_scheduler.schedule_task(task)
+    if recurrence:
+        await update.message.reply_text(f"✅ Task added! It repeats {describe(recurrence)}.")
+    else:
+        await update.message.reply_text("✅ Task added!")
     context.user_data.clear()
     return ConversationHandler.END
 
 async def list_tasks(update: Update, context: CallbackContext) -> None:
     user_id = update.message.from_user.id
-    tasks = tasks_collection.find({"user_id": user_id, "status": "pending"})
+    page = await render_page("t", user_id)
     
-    if tasks_collection.count_documents({"user_id": user_id, "status": "pending"}) == 0:
+    if not page:
         await update.message.reply_text("You have no pending tasks.")
         return
     
-    tasks_list = []
-    for task in tasks:
-        tasks_list.append(
-            f"📌 {task['title']}\n"
-            f"📝 {task.get('description', 'No description')}\n"
-            f"📅 Due: {task['due_date'].strftime('%Y-%m-%d')}"
-        )
-    await update.message.reply_text("Your tasks:\n" + "\n\n".join(tasks_list))
+    text, reply_markup = page
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+async def turn_page(update: Update, context: CallbackContext) -> None:
+    """Handle the Prev/Next buttons of every paginated task list."""
+    query = update.callback_query
+    view, direction, cursor = decode_cursor(query.data)
+    page = await render_page(view, query.from_user.id, direction, cursor)
+
+    if not page:
+        await query.answer("No more tasks.")
+        return
+
+    text, reply_markup = page
+    await query.answer()
+    await query.edit_message_text(text, reply_markup=reply_markup)
 
 
 
@@ -210,16 +269,14 @@ SELECT_TASK, SELECT_FIELD, EDIT_FIELD = range(3)
 async def edit_task(update: Update, context: CallbackContext) -> int:
     """Send a list of tasks to select one for editing."""
     user_id = update.message.from_user.id
-    tasks = tasks_collection.find({"user_id": user_id, "status": "pending"})
+    page = await render_page("e", user_id)
 
-    if tasks_collection.count_documents({"user_id": user_id, "status": "pending"}) == 0:
+    if not page:
         await update.message.reply_text("You have no pending tasks to edit.")
         return ConversationHandler.END
 
-    keyboard = [[InlineKeyboardButton(task["title"], callback_data=f"edit_{task['_id']}")] for task in tasks]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    await update.message.reply_text("Select a task to edit:", reply_markup=reply_markup)
+    text, reply_markup = page
+    await update.message.reply_text(text, reply_markup=reply_markup)
     return SELECT_TASK
 
 async def select_task(update: Update, context: CallbackContext) -> int:
@@ -231,7 +288,8 @@ async def select_task(update: Update, context: CallbackContext) -> int:
     keyboard = [
         [InlineKeyboardButton("✏ Title", callback_data="edit_title")],
         [InlineKeyboardButton("📝 Description", callback_data="edit_description")],
-        [InlineKeyboardButton("📅 Due Date", callback_data="edit_due_date")]
+        [InlineKeyboardButton("📅 Due Date", callback_data="edit_due_date")],
+        [InlineKeyboardButton("🔁 Repeat", callback_data="edit_recurrence")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
@@ -242,7 +300,7 @@ async def select_task(update: Update, context: CallbackContext) -> int:
 async def select_field(update: Update, context: CallbackContext) -> int:
     """Ask for new input based on the selected field."""
     query = update.callback_query
-    field = query.data.split("_")[1]
+    field = query.data.split("_", 1)[1]
     context.user_data["field"] = field 
 
     if field == "title":
@@ -251,6 +309,8 @@ async def select_field(update: Update, context: CallbackContext) -> int:
         await query.edit_message_text("Enter the new description:")
     elif field == "due_date":
         await query.edit_message_text("Enter the new due date (YYYY-MM-DD):")
+    elif field == "recurrence":
+        await query.edit_message_text(f"How should it repeat? ({RECURRENCE_HELP}, or never)")
 
     return EDIT_FIELD
 
@@ -261,6 +321,7 @@ async def edit_field(update: Update, context: CallbackContext) -> int:
     new_value = update.message.text
 
     update_data = {}
+    unset = {}
     if field == "title":
         update_data["title"] = new_value
     elif field == "description":
@@ -272,8 +333,33 @@ async def edit_field(update: Update, context: CallbackContext) -> int:
         except ValueError:
             await update.message.reply_text("❌ Invalid date format! Please use YYYY-MM-DD.")
             return EDIT_FIELD
-
-    tasks_collection.update_one({"_id": ObjectId(task_id)}, {"$set": update_data})
+        # A recurring task's later occurrences follow from the new date
+        unset["series_start"] = ""
+    elif field == "recurrence":
+        # A new rule starts a new series; keeping series_id with occurrence
+        # reset would collide with the old series' next occurrences.
+        unset.update(series_id="", series_start="", occurrence="")
+        if new_value.strip().lower() in ("never", "none", "no"):
+            unset["recurrence"] = ""
+        else:
+            try:
+                update_data["recurrence"] = format_rule(parse_recurrence(new_value))
+            except ValueError as e:
+                await update.message.reply_text(f"❌ {e}. Try {RECURRENCE_HELP}, or never.")
+                return EDIT_FIELD
+
+    changes = {"$set": update_data} if update_data else {}
+    if unset:
+        changes["$unset"] = unset
+    task = await tasks_collection.find_one_and_update(
+        {"_id": ObjectId(task_id)},
+        changes,
+        return_document=ReturnDocument.AFTER
+    )
+    if task:
+        tasks_changed(task["user_id"])
+    if task and "due_date" in update_data:
+        reminder_scheduler.schedule_task(task)
     await update.message.reply_text("✅ Task updated successfully!")
 
     return ConversationHandler.END
@@ -291,16 +377,14 @@ async def cancel_edit(update: Update, context: CallbackContext) -> int:
 async def show_mark_done_tasks(update: Update, context: CallbackContext) -> None:
     """Handle the /done command."""
     user_id = update.message.from_user.id
-    tasks = list(tasks_collection.find({"user_id": user_id, "status": "pending"}))  # Convert cursor to list
+    page = await render_page("d", user_id)
 
-    if not tasks:
+    if not page:
         await update.message.reply_text("You have no tasks to mark as done.")
         return
 
-    keyboard = [[InlineKeyboardButton(task["title"], callback_data=f"done_{str(task['_id'])}")] for task in tasks]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    await update.message.reply_text("Select a task to mark as done:", reply_markup=reply_markup)
+    text, reply_markup = page
+    await update.message.reply_text(text, reply_markup=reply_markup)
 
 async def mark_done_callback(update: Update, context: CallbackContext) -> None:
     """Handle the callback query for marking a task as done."""
@@ -314,58 +398,342 @@ async def mark_done_callback(update: Update, context: CallbackContext) -> None:
         await query.answer("Invalid task ID.")
         return
 
-    task = tasks_collection.find_one({"_id": task_object_id, "user_id": user_id})
+    tasks, next_tasks = await complete_tasks(user_id, [task_object_id])
     
-    if not task:
+    if not tasks:
         await query.answer("Task not found or already completed.")
         return
 
-    tasks_collection.update_one({"_id": task_object_id}, {"$set": {"status": "completed"}})
-
     await query.answer("✅ Task marked as done!")
-    await query.edit_message_text(f"✅ Task '{task['title']}' marked as done.")
+    message = f"✅ Task '{tasks[0]['title']}' marked as done."
+    await query.edit_message_text(message + next_due_text(next_tasks))
+
+async def complete_tasks(user_id: int, task_ids: list):
+    """Mark the user's pending tasks among `task_ids` completed; returns (tasks, next_tasks).
+
+    Completions and the next occurrences of recurring tasks go out in one
+    bulk_write. Next occurrences are upserted on (series_id, occurrence),
+    which a unique index backs, so completing a task twice at once still
+    creates its next one only once.
+    """
+    now = datetime.utcnow()
+    tasks = await tasks_collection.find(
+        {"_id": {"$in": task_ids}, "user_id": user_id, "status": "pending"}
+    ).to_list(None)
+    if not tasks:
+        return [], []
+
+    next_tasks = [next_occurrence(task, now) for task in tasks if task.get("recurrence")]
+    next_tasks = [next_task for next_task in next_tasks if next_task]
+    writes = [UpdateMany(
+        {"_id": {"$in": [task["_id"] for task in tasks]}, "status": "pending"},
+        {"$set": {"status": "completed", "completed_at": now}}
+    )]
+    writes += [
+        UpdateOne(
+            {"series_id": next_task["series_id"], "occurrence": next_task["occurrence"]},
+            {"$setOnInsert": next_task},
+            upsert=True
+        )
+        for next_task in next_tasks
+    ]
+    try:
+        result = await tasks_collection.bulk_write(writes, ordered=False)
+        modified, upserted = result.modified_count, result.upserted_ids
+    except BulkWriteError as e:
+        # Two upserts raced and the other one created the next occurrence.
+        if any(error["code"] != DUPLICATE_KEY for error in e.details["writeErrors"]):
+            raise
+        modified = e.details["nModified"]
+        upserted = {item["index"]: item["_id"] for item in e.details["upserted"]}
 
+    for task in tasks:
+        reminder_scheduler.cancel_task(task["_id"])
+    # Next occurrences that already existed were created by the other completion.
+    for index, task_id in upserted.items():
+        next_tasks[index - 1]["_id"] = task_id
+    next_tasks = [next_task for next_task in next_tasks if "_id" in next_task]
+    for next_task in next_tasks:
+        reminder_scheduler.schedule_task(next_task)
+    tasks_changed(user_id)
+
+    if modified:
+        await update_stats(user_id, {"completed_tasks": modified})
+    return tasks, next_tasks
+
+def next_due_text(next_tasks: list) -> str:
+    if len(next_tasks) == 1:
+        return f"\n🔁 Next one is due {next_tasks[0]['due_date']:%Y-%m-%d}."
+    if next_tasks:
+        return f"\n🔁 {len(next_tasks)} recurring tasks have a next occurrence."
+    return ""
+
+# MULTI-SELECT
+async def select_tasks(update: Update, context: CallbackContext) -> int:
+    """Handle /select: tick tasks, then complete, delete, reschedule or focus on them together."""
+    selection = {"selected": []}
+    if not await fetch_selection_page(selection, update.message.from_user.id):
+        await update.message.reply_text("You have no pending tasks.")
+        return ConversationHandler.END
 
+    text, reply_markup = render_selection(selection)
+    message = await update.message.reply_text(text, reply_markup=reply_markup)
+    selection["message_id"] = message.message_id
+    context.user_data["selection"] = selection
+    return SELECTING
 
+async def selection_callback(update: Update, context: CallbackContext) -> int:
+    """Handle the checkboxes, Prev/Next and action buttons of /select.
+
+    The selection lives in user_data, so ticking a task is one keyboard edit
+    and no database round trip; each action is one write and one edit.
+    """
+    query = update.callback_query
+    user_id = query.from_user.id
+    selection = context.user_data.get("selection")
+    if not selection or query.message.message_id != selection["message_id"]:
+        await query.answer("This selection has expired. Use /select again.")
+        return SELECTING if selection else ConversationHandler.END
+
+    kind, value = query.data.split(":")[1:3]
+    if kind == "t":
+        if value in selection["selected"]:
+            selection["selected"].remove(value)
+        elif any(task_id == value for task_id, _ in selection["page"]):
+            selection["selected"].append(value)
+        else:
+            await query.answer("This task is not on the page.")
+            return SELECTING
+    elif kind == "s":
+        _, direction, cursor = decode_cursor(query.data)
+        if not await fetch_selection_page(selection, user_id, direction, cursor):
+            await query.answer("No more tasks.")
+            return SELECTING
+    elif value == "cancel":
+        context.user_data.pop("selection")
+        await query.answer()
+        await query.edit_message_text("Selection cleared.")
+        return ConversationHandler.END
+    elif value != "back":
+        if not selection["selected"]:
+            await query.answer("Tick at least one task first.")
+            return SELECTING
+        return await run_selection_action(query, context, value)
+
+    await query.answer()
+    text, reply_markup = render_selection(selection)
+    await query.edit_message_text(text, reply_markup=reply_markup)
+    return SELECTING
+
+async def run_selection_action(query, context: CallbackContext, action: str) -> int:
+    user_id = query.from_user.id
+    selected = context.user_data["selection"]["selected"]
+    task_ids = [ObjectId(task_id) for task_id in selected]
+
+    if action == "delete":
+        keyboard = [[
+            InlineKeyboardButton(f"🗑 Delete {len(task_ids)} tasks", callback_data="bs:a:delete_yes"),
+            InlineKeyboardButton("◀ Back", callback_data="bs:a:back"),
+        ]]
+        await query.answer()
+        await query.edit_message_text(
+            f"Delete {len(task_ids)} tasks? This cannot be undone.", reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return SELECTING
+
+    if action == "date":
+        await query.answer()
+        await query.edit_message_text(f"Enter the new due date for {len(task_ids)} tasks (YYYY-MM-DD):")
+        return RESCHEDULE
+
+    if action == "pomodoro":
+        if await pomodoro_timers.get(user_id):
+            await query.answer("❗ You have an active session!")
+            return SELECTING
+        context.user_data["pomodoro_task"] = selected[0]
+        context.user_data["pomodoro_tasks"] = list(selected)
+        context.user_data.pop("selection")
+        await query.answer()
+        await query.edit_message_text(
+            f"🍅 Focusing on {len(task_ids)} tasks. How many Pomodoro sessions would you like to do?"
+        )
+        return NUM_SESSIONS
+
+    if action == "done":
+        tasks, next_tasks = await complete_tasks(user_id, task_ids)
+        message = f"✅ {len(tasks)} tasks marked as done." + next_due_text(next_tasks)
+    elif action == "delete_yes":
+        result = await tasks_collection.delete_many({"_id": {"$in": task_ids}, "user_id": user_id})
+        for task_id in task_ids:
+            reminder_scheduler.cancel_task(task_id)
+        tasks_changed(user_id)
+        message = f"🗑 {result.deleted_count} tasks deleted."
+    else:
+        await query.answer()
+        return SELECTING
+    context.user_data.pop("selection")
+    await query.answer()
+    await query.edit_message_text(message)
+    return ConversationHandler.END
+
+async def reschedule_selection(update: Update, context: CallbackContext) -> int:
+    try:
+        due_date = datetime.strptime(update.message.text, "%Y-%m-%d")
+    except ValueError:
+        await update.message.reply_text("❌ Invalid date format! Please use YYYY-MM-DD.")
+        return RESCHEDULE
+
+    user_id = update.message.from_user.id
+    selection = context.user_data.pop("selection")
+    task_ids = [ObjectId(task_id) for task_id in selection["selected"]]
+    result = await tasks_collection.update_many(
+        {"_id": {"$in": task_ids}, "user_id": user_id, "status": "pending"},
+        # Later occurrences of recurring tasks follow from the new date
+        {"$set": {"due_date": due_date}, "$unset": {"series_start": ""}}
+    )
+    async for task in tasks_collection.find(
+        {"_id": {"$in": task_ids}, "user_id": user_id}, {"user_id": 1, "due_date": 1, "status": 1, "reminded_for": 1}
+    ):
+        reminder_scheduler.schedule_task(task)
+    tasks_changed(user_id)
+
+    await context.bot.edit_message_text(
+        chat_id=update.effective_chat.id,
+        message_id=selection["message_id"],
+        text=f"📅 {result.matched_count} tasks moved to {due_date:%Y-%m-%d}."
+    )
+    return ConversationHandler.END
+
+
+
+
+# TASK SEARCH
+async def search(update: Update, context: CallbackContext) -> None:
+    """Handle /search <words> over the user's task titles and descriptions."""
+    user_id = update.message.from_user.id
+    text = " ".join(context.args).strip()[:MAX_QUERY]
+    if not text:
+        await update.message.reply_text("Usage: /search <words>")
+        return
+
+    page = await render_search(user_id, text)
+    if not page:
+        await update.message.reply_text(f"No tasks match “{text}”.")
+        return
+
+    # The query is too long for callback_data, so paging reads it from here.
+    context.user_data["search"] = text
+    message, reply_markup = page
+    await update.message.reply_text(message, reply_markup=reply_markup)
+
+async def turn_search_page(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    text = context.user_data.get("search")
+    page = await render_search(query.from_user.id, text, int(query.data.split(":")[1])) if text else None
+
+    if not page:
+        await query.answer("This search has expired, run /search again.")
+        return
+
+    message, reply_markup = page
+    await query.answer()
+    await query.edit_message_text(message, reply_markup=reply_markup)
 
 # TASK HISTORY
 async def show_completed_tasks(update: Update, context: CallbackContext) -> None:
     """Handle the /completed_tasks command."""
     user_id = update.message.from_user.id
-    tasks = tasks_collection.find({"user_id": user_id, "status": "completed"})
+    page = await render_page("c", user_id) or await render_archive_page(user_id)
 
-    if tasks_collection.count_documents({"user_id": user_id, "status": "completed"}) == 0:
+    if not page:
         await update.message.reply_text("You have no completed tasks.")
     else:
-        tasks_list = []
-        for task in tasks:
-            tasks_list.append(
-                f"✅ {task['title']}\n"
-                f"📝 {task['description']}\n"
-                f"📅 Due: {task['due_date'].strftime('%Y-%m-%d')}\n"
+        text, reply_markup = page
+        await update.message.reply_text(text, reply_markup=reply_markup)
+
+async def turn_archive_page(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    page = await render_archive_page(query.from_user.id, int(query.data.split(":")[1]))
+
+    if not page:
+        await query.answer("No more tasks.")
+        return
+
+    text, reply_markup = page
+    await query.answer()
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+# IMPORT / EXPORT
+async def import_start(update: Update, context: CallbackContext) -> int:
+    await update.message.reply_text(
+        "📥 Send a CSV or JSON file with title, description and due_date (YYYY-MM-DD) "
+        "columns. An optional status column can be pending or completed, and an optional "
+        "recurrence column says how a task repeats (daily, weekly, FREQ=WEEKLY;BYDAY=MO...).\n"
+        "Send /cancel to stop."
+    )
+    return IMPORT_FILE
+
+async def import_file(update: Update, context: CallbackContext) -> int:
+    user_id = update.message.from_user.id
+    document = update.message.document
+    fmt = file_format(document.file_name, document.mime_type)
+    if not fmt:
+        await update.message.reply_text("❌ Please send a .csv, .json or .ndjson file.")
+        return IMPORT_FILE
+    if document.file_size and document.file_size > MAX_IMPORT_BYTES:
+        await update.message.reply_text("❌ That file is too big, the limit is 20 MB.")
+        return ConversationHandler.END
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "import")
+        file = await document.get_file()
+        await file.download_to_drive(path)
+        try:
+            result = await import_tasks(user_id, path, fmt, on_inserted=reminder_scheduler.schedule_task)
+        finally:
+            tasks_changed(user_id)
+
+    if result["completed"]:
+        await update_stats(user_id, {"completed_tasks": result["completed"]})
+
+    message = f"✅ Imported {result['imported']} tasks."
+    if result["rejected"]:
+        message += f"\n⚠️ Skipped {result['rejected']} invalid rows."
+    for row, error in result["errors"]:
+        message += f"\n• row {row}: {error}" if row else f"\n• {error}"
+    await update.message.reply_text(message)
+    return ConversationHandler.END
+
+async def export_data(update: Update, context: CallbackContext) -> None:
+    """Send the user's tasks and Pomodoro history as an NDJSON document."""
+    user_id = update.message.from_user.id
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "export.ndjson")
+        counts = await export_tasks(user_id, path)
+        if not counts["tasks"] and not counts["sessions"]:
+            await update.message.reply_text("Nothing to export yet.")
+            return
+        with open(path, "rb") as file:
+            await update.message.reply_document(
+                file,
+                filename=f"tasks-{datetime.utcnow():%Y-%m-%d}.ndjson",
+                caption=f"📦 {counts['tasks']} tasks and {counts['sessions']} Pomodoro sessions",
             )
-        await update.message.reply_text("Your completed tasks:\n" + "\n".join(tasks_list))
 
 # POMODORO SESSIONS
 async def pomodoro(update: Update, context: CallbackContext) -> int:
     user_id = update.message.from_user.id
-    if user_id in active_timers:
+    if await pomodoro_timers.get(user_id):
         await update.message.reply_text("❗ You have an active session!")
         return ConversationHandler.END
     
-    tasks = tasks_collection.find({"user_id": user_id, "status": "pending"})
-    if tasks_collection.count_documents({"user_id": user_id, "status": "pending"}) == 0:
+    page = await render_page("p", user_id)
+    if not page:
         await update.message.reply_text("❌ No pending tasks!")
         return ConversationHandler.END
     
-    keyboard = [
-        [InlineKeyboardButton(task["title"], callback_data=f"task_{task['_id']}")]
-        for task in tasks
-    ]
-    await update.message.reply_text(
-        "Select task for session:",
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
+    text, reply_markup = page
+    await update.message.reply_text(text, reply_markup=reply_markup)
     return TASK_SELECTED
 
 async def task_selected(update: Update, context: CallbackContext) -> int:
@@ -374,6 +742,7 @@ async def task_selected(update: Update, context: CallbackContext) -> int:
     task_id = query.data.split("_")[1]
     
     context.user_data["pomodoro_task"] = task_id
+    context.user_data.pop("pomodoro_tasks", None)
     await query.edit_message_text("How many Pomodoro sessions would you like to do?")
     return NUM_SESSIONS
 
@@ -425,136 +794,57 @@ async def get_break_time(update: Update, context: CallbackContext) -> int:
 async def start_pomodoro_session(update: Update, context: CallbackContext) -> int:
     user_id = update.message.from_user.id
     settings = context.user_data
-    task_id = settings["pomodoro_task"]
-    
-    session_data = {
-        "start_time": datetime.utcnow(),
-        "work_time": settings["work_time"],
-        "break_time": settings["break_time"],
-        "num_sessions": settings["num_sessions"],
-        "sessions_completed": 0,
-        "task_id": task_id,
-        "active": True,
-        "task": None
-    }
-    
-    timer_task = asyncio.create_task(run_pomodoro_cycle(update, context, user_id))
-    session_data["task"] = timer_task
-    active_timers[user_id] = session_data
-    
-    return ConversationHandler.END
 
-async def run_pomodoro_cycle(update: Update, context: CallbackContext, user_id: int):
-    session_data = active_timers.get(user_id)
-    if not session_data:
-        return
-
-    try:
-        for session in range(session_data["num_sessions"]):
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=f"Session {session+1}/{session_data['num_sessions']} started! 🎯"
-            )
-            await asyncio.sleep(session_data["work_time"] * 60)
-            
-            if not active_timers.get(user_id):
-                return
-                
-            session_data["sessions_completed"] += 1
-            
-            if session < session_data["num_sessions"] - 1:
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=f"⏰ Break time! ({session_data['break_time']} minutes)"
-                )
-                await asyncio.sleep(session_data["break_time"] * 60)
-                
-                if not active_timers.get(user_id):
-                    return
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text="Back to work! 💪"
-                )
-
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="🎉 All sessions completed!"
-        )
-        await ask_task_completion(update, context, user_id)
-        
-    except asyncio.CancelledError:
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="🛑 Session interrupted!"
-        )
-
-async def ask_task_completion(update: Update, context: CallbackContext, user_id: int):
-    session_data = active_timers.get(user_id)
-    if not session_data:
-        return
-
-    task_id = session_data["task_id"]
-    task = tasks_collection.find_one({"_id": ObjectId(task_id)})
-    
-    keyboard = [
-        [InlineKeyboardButton("Yes", callback_data="task_done_yes"),
-         InlineKeyboardButton("No", callback_data="task_done_no")]
-    ]
-    
-    await context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text=f"Did you complete the task: {task['title']}?",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+    await pomodoro_timers.begin(
+        user_id,
+        update.effective_chat.id,
+        settings["pomodoro_task"],
+        settings["num_sessions"],
+        settings["work_time"],
+        settings["break_time"],
+        settings.get("pomodoro_tasks"),
     )
+    
+    return ConversationHandler.END
 
 async def stop_pomodoro(update: Update, context: CallbackContext) -> None:
     """Stop an active Pomodoro session."""
     user_id = update.message.from_user.id
-    session_data = active_timers.get(user_id)
+    session_data = await pomodoro_timers.end(user_id)
     
     if not session_data:
         await update.message.reply_text("❌ No active session to stop!")
         return
-
-    if session_data.get("task"):
-        session_data["task"].cancel()
     
-    pomodoro_collection.insert_one({
-        "user_id": user_id,
-        "task_id": ObjectId(session_data["task_id"]),
-        "start_time": session_data["start_time"],
-        "end_time": datetime.utcnow(),
-        "work_duration": session_data["work_time"],
-        "break_duration": session_data["break_time"],
-        "sessions_completed": session_data["sessions_completed"],
-        "total_sessions": session_data["num_sessions"],
-        "completed": False
-    })
+    # Finished sessions were recorded when their last phase ended.
+    if session_data["phase"] != DONE:
+        pomodoro_timers.countdown.finish(session_data, "🛑 Session stopped.")
+        partial_focus = pomodoro_timers.partial_focus(session_data, datetime.utcnow())
+        await pomodoro_collection.insert_one(
+            pomodoro_timers.history_record(session_data, completed=False, partial_focus=partial_focus)
+        )
+        report_cache.bump(user_id)
+        if partial_focus:
+            await update_stats(user_id, {"total_focus": partial_focus})
     
-    active_timers.pop(user_id, None)
     await update.message.reply_text("🛑 Session stopped. Progress saved!")
 
 async def handle_task_completion(update: Update, context: CallbackContext):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    session_data = active_timers.get(user_id)
+    session_data = await pomodoro_timers.end(user_id)
     
     if not session_data:
         await query.edit_message_text("Session data not found!")
         return
 
-    task_id = session_data["task_id"]
-
-    active_timers.pop(user_id, None)
+    task_ids = session_data.get("task_ids") or [session_data["task_id"]]
     
     if query.data == "task_done_yes":
-        tasks_collection.update_one(
-            {"_id": ObjectId(task_id)},
-            {"$set": {"status": "completed"}}
-        )
-        await query.edit_message_text("✅ Task marked as completed!")
-        await update_stats(user_id, "completed_tasks", 1)
+        tasks, next_tasks = await complete_tasks(user_id, [ObjectId(task_id) for task_id in task_ids])
+        message = "✅ Task marked as completed!" if len(task_ids) == 1 else f"✅ {len(tasks)} tasks marked as completed!"
+        await query.edit_message_text(message + next_due_text(next_tasks))
     else:
         await query.edit_message_text("Task remains pending. Keep working!")
 
@@ -563,7 +853,7 @@ async def handle_task_completion(update: Update, context: CallbackContext):
 # USER STATS
 async def show_stats(update: Update, context: CallbackContext) -> None:
     user_id = update.message.from_user.id
-    stats = stats_collection.find_one({"user_id": user_id})
+    stats = await read_stats(user_id)
     
     if not stats:
         await update.message.reply_text("No statistics available yet.")
@@ -571,13 +861,35 @@ async def show_stats(update: Update, context: CallbackContext) -> None:
     
     message = (
         "📊 Your Productivity Stats:\n"
-        f"🏋️ Total Pomodoro Sessions: {stats['total_sessions']}\n"
-        f"⏱️ Total Focus Time: {stats['total_focus']} minutes\n"
-        f"✅ Completed Tasks: {stats['completed_tasks']}\n"
-        f"🔥 Today's Sessions: {stats['daily_sessions']}"
+        f"🏋️ Total Pomodoro Sessions: {stats.get('total_sessions', 0)}\n"
+        f"⏱️ Total Focus Time: {stats.get('total_focus', 0)} minutes\n"
+        f"✅ Completed Tasks: {stats.get('completed_tasks', 0)}\n"
+        f"🔥 Today's Sessions: {stats.get('daily_sessions', 0)}"
     )
     await update.message.reply_text(message)
 
+async def show_report(update: Update, context: CallbackContext) -> None:
+    """Handle /report [week|month|year]."""
+    user_id = update.message.from_user.id
+    period = context.args[0].lower() if context.args else "week"
+    if period not in PERIODS:
+        await update.message.reply_text("Usage: /report [week|month|year]")
+        return
+
+    try:
+        result = await build_report(user_id, period)
+    except ImportError:
+        logger.exception("Reports need numpy and matplotlib")
+        await update.message.reply_text("❌ Reports are not available on this bot.")
+        return
+    if not result:
+        await update.message.reply_text(f"No activity in the last {period} yet.")
+        return
+
+    message = await update.message.reply_photo(result["photo"], caption=result["caption"])
+    # The cached report sends Telegram's copy from now on instead of uploading again.
+    result["photo"] = message.photo[-1].file_id
+
 # SETTINGS
 async def show_settings(update: Update, context: CallbackContext) -> None:
     user_id = update.message.from_user.id
@@ -606,68 +918,229 @@ async def toggle_notifications(update: Update, context: CallbackContext) -> None
     current_setting = await get_user_settings(user_id)
     new_value = not current_setting.get("notifications", True)  
 
-    settings_collection.update_one(
+    settings = await settings_collection.find_one_and_update(
         {"user_id": user_id},
         {"$set": {"notifications": new_value}},
-        upsert=True
+        upsert=True,
+        return_document=ReturnDocument.AFTER
     )
+    settings_cache.set(user_id, settings)
+    if new_value:
+        await reminder_scheduler.schedule_user(user_id)
 
     await query.edit_message_text(
         f"🔔 Notifications {'Enabled' if new_value else 'Disabled'}!"
     )
 
 
-# NOTIFICATIONS
-def send_telegram_message(user_id, task_name, due_time):
-    message = f"🔔Reminder: Task '{task_name}' is due at {due_time}!"
-    telegram_url = f"https://api.telegram.org/bot{TOKEN}/sendMessage"
+# BROADCASTS
+async def broadcast(update: Update, context: CallbackContext) -> None:
+    """Handle /broadcast <text> (admins only); without text, show the latest job."""
+    user_id = update.message.from_user.id
+    if not is_admin(user_id):
+        await update.message.reply_text("❌ Only admins can broadcast.")
+        return
 
-    params = {
-        "chat_id": user_id,  
-        "text": message
-    }
+    # Everything after the command, line breaks included.
+    parts = update.message.text.split(maxsplit=1)
+    text = parts[1].strip() if len(parts) > 1 else ""
+    if not text:
+        job = await latest_job()
+        if job:
+            await update.message.reply_text(progress_text(job))
+        else:
+            await update.message.reply_text("Usage: /broadcast <message>")
+        return
+
+    progress = await update.message.reply_text("📣 Broadcast queued…")
+    job = await create_job(text, user_id, update.effective_chat.id, progress.message_id)
+    await progress.edit_text(progress_text(job))
 
-    response = requests.post(telegram_url, params=params)
-    if response.status_code == 200:
-        print(f"Notification sent to {user_id}")
+async def cancel_broadcast(update: Update, context: CallbackContext) -> None:
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ Only admins can broadcast.")
+        return
+    job = await cancel_job()
+    if job:
+        await update.message.reply_text(progress_text(job))
     else:
-        print(f"Failed to send message: {response.text}")
+        await update.message.reply_text("No broadcast is running.")
 
-def schedule_notifications():
-    while True:
-        try:
-            print("Checking for upcoming tasks...")
-            now = datetime.utcnow()
-            upcoming_time = now + timedelta(minutes=2000) 
+broadcast_runner = BroadcastRunner()
 
-            tasks = tasks_collection.find({
-                "due_date": {"$gte": now, "$lte": upcoming_time},  
-                "status": "pending"  
-            })
 
-            for task in tasks:
-                settings = settings_collection.find_one({"user_id": task["user_id"]})
+# NOTIFICATIONS
+async def send_telegram_message(bot, user_id, task_name, due_time):
+    message = f"🔔Reminder: Task '{task_name}' is due at {due_time}!"
 
-                if settings and settings.get("notifications", False):  
-                    user = users_collection.find_one({"user_id": task["user_id"]})
-                    if user:
-                        send_telegram_message(user["user_id"], task["title"], task["due_date"])
-                else:
-                    print(f"User {task['user_id']} has notifications disabled or settings not found")
+    try:
+        await bot.send_message(chat_id=user_id, text=message, rate_limit_args=BULK)
+        logger.info(f"Notification sent to {user_id}")
+    except TelegramError as e:
+        logger.warning(f"Failed to send message: {e}")
 
+reminder_scheduler = ReminderScheduler()
+# Archives the history of the users whose reminders this worker sends.
+archiver = Archiver(lambda: reminder_scheduler.partitions)
 
-        except Exception as e:
-            print(f"Error in schedule_notifications: {e}")
-        
-        time.sleep(6000)
+
+async def on_startup(application: Application) -> None:
+    """Start the background machinery without waiting for Mongo.
+
+    Updates are accepted as soon as this returns; indexes, the first
+    connections and Pomodoro recovery are handled by `warm_up` meanwhile.
+    """
+    if CLUSTER:
+        await start_cluster(application)
+    else:
+        # Until recovery finishes, sessions are looked up in Mongo.
+        pomodoro_timers.recovered = False
+        if WATCH_TASKS:
+            application.bot_data["change_feeds"] = [
+                asyncio.create_task(follow_changes(tasks_collection, on_task_change, pre_images=True))
+            ]
+    reminder_scheduler.start(partial(send_telegram_message, application.bot))
+    pomodoro_timers.start(application.bot)
+    archiver.start()
+    broadcast_runner.start(application.bot)
+    application.bot_data["warm_up"] = asyncio.create_task(warm_up())
+    if METRICS_PORT:
+        metrics_server = MetricsServer()
+        await metrics_server.start()
+        application.bot_data["metrics_server"] = metrics_server
+
+async def warm_up() -> None:
+    """Build indexes, open a connection and recover Pomodoro sessions, retrying until it works."""
+    started = time.perf_counter()
+    delay = 1
+    while True:
+        steps = [init_db(), ping_db()]
+        if not CLUSTER:
+            steps.append(pomodoro_timers.recover())
+        try:
+            await asyncio.gather(*steps)
+            break
+        except Exception:
+            logger.exception("Startup warm-up failed, retrying in %d s", delay)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 60)
+    pomodoro_timers.recovered = True
+    STARTUP_SECONDS.set(time.perf_counter() - started, phase="warm_up")
+    logger.info("Warm-up finished in %.0f ms", (time.perf_counter() - started) * 1000)
+
+async def on_shutdown(application: Application) -> None:
+    warm_up_task = application.bot_data.pop("warm_up", None)
+    if warm_up_task:
+        warm_up_task.cancel()
+    for cache in (settings_cache, profile_cache):
+        logger.info("%s cache: %s", cache.name, cache.stats())
+    metrics_server = application.bot_data.pop("metrics_server", None)
+    if metrics_server:
+        await metrics_server.stop()
+    await reminder_scheduler.stop()
+    await pomodoro_timers.stop()
+    await archiver.stop()
+    await broadcast_runner.stop()
+    shutdown_chart_pool()
+    await stop_cluster(application)
+    await stats_buffer.stop()
+    await close_db()
+
+
+# CLUSTER
+async def start_cluster(application: Application) -> None:
+    """Own no users until the partition manager hands this worker a share."""
+    reminder_scheduler.partitions = set()
+    pomodoro_timers.partitions = set()
+
+    async def on_acquire(partitions):
+        await reminder_scheduler.add_partitions(partitions)
+        await pomodoro_timers.add_partitions(partitions)
+
+    async def on_release(partitions):
+        reminder_scheduler.drop_partitions(partitions)
+        pomodoro_timers.drop_partitions(partitions)
+
+    async def on_poller_change(polling):
+        if polling:
+            logger.info("Worker %s is now polling for updates", WORKER_ID)
+            await application.updater.start_polling()
+        elif application.updater.running:
+            await application.updater.stop()
+
+    application.bot_data["change_feeds"] = [
+        asyncio.create_task(follow_changes(tasks_collection, on_task_change, pre_images=True)),
+        asyncio.create_task(follow_changes(timers_collection, pomodoro_timers.on_change)),
+    ]
+    partition_manager = PartitionManager(
+        on_acquire, on_release, None if WEBHOOK_URL else on_poller_change
+    )
+    partition_manager.start()
+    application.bot_data["partition_manager"] = partition_manager
+
+async def on_task_change(change: dict) -> None:
+    await page_cache.on_change(change)
+    # A single worker already hears about every task change from its handlers.
+    if CLUSTER:
+        await reminder_scheduler.on_change(change)
+
+async def stop_cluster(application: Application) -> None:
+    for feed in application.bot_data.pop("change_feeds", []):
+        feed.cancel()
+    partition_manager = application.bot_data.pop("partition_manager", None)
+    if partition_manager:
+        await partition_manager.stop()
+
+async def run_worker(application: Application) -> None:
+    """Run one worker of a cluster.
+
+    In webhook mode every worker serves the webhook behind the load balancer;
+    otherwise polling is switched on only while it holds the poller lease.
+    """
+    # Checked before anything starts; webhook_kwargs refuses a missing secret.
+    webhook = webhook_kwargs() if WEBHOOK_URL else None
+    stop_signal = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_signal.set)
+
+    async with application:
+        await on_startup(application)
+        await application.start()
+        if webhook:
+            await application.updater.start_webhook(**webhook)
+        await stop_signal.wait()
+        # Stop accepting updates first, then let in-flight ones finish.
+        if application.updater.running:
+            await application.updater.stop()
+        await application.stop()
+    # After the application has shut down and flushed its persistence.
+    await on_shutdown(application)
 
 
 # MAIN
-def main():
-    application = Application.builder().token(TOKEN).build()
+def build_application(builder=None, rate_limiter=None) -> Application:
+    """Build the Application with every handler registered.
+
+    benchmarks/load_test.py passes its own builder (fake Bot API) and limiter.
+    """
+    if builder is None:
+        builder = Application.builder().token(TOKEN)
+    persistence = MongoPersistence()
+    builder = (
+        builder
+        .persistence(persistence)
+        .rate_limiter(rate_limiter or OutboundLimiter())
+        .concurrent_updates(PerUserUpdateProcessor())
+    )
+    if not CLUSTER:
+        builder = builder.post_init(on_startup).post_shutdown(on_shutdown)
+    application = builder.build()
     
     # Task conversation handler
     task_handler = ConversationHandler(
+        name="addtask",
+        persistent=True,
         entry_points=[CommandHandler("addtask", add_task)],
         states={
             TITLE: [MessageHandler(filters.TEXT & ~filters.COMMAND, task_title)],
@@ -675,7 +1148,11 @@ def main():
                 MessageHandler(filters.TEXT & ~filters.COMMAND, task_description),
                 CommandHandler("skip", skip_description)
             ],
-            DUE_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, task_due_date)]
+            DUE_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, task_due_date)],
+            RECURRENCE: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, task_recurrence),
+                CommandHandler("skip", skip_recurrence)
+            ]
         },
         fallbacks=[CommandHandler("cancel", cancel)]
     )
@@ -683,6 +1160,8 @@ def main():
     
     # Pomodoro conversation handler
     pomodoro_handler = ConversationHandler(
+        name="pomodoro",
+        persistent=True,
         entry_points=[CommandHandler("pomodoro", pomodoro)],
         states={
             TASK_SELECTED: [CallbackQueryHandler(task_selected, pattern="^task_")],
@@ -695,19 +1174,54 @@ def main():
 
     # Add to ConversationHandler
     edit_task_handler = ConversationHandler(
-        entry_points=[CommandHandler("edit_task", edit_task)],
+        name="edit_task",
+        persistent=True,
+        entry_points=[
+            CommandHandler("edit_task", edit_task),
+            # Edit buttons of /search results
+            CallbackQueryHandler(select_task, pattern="^edit_[0-9a-f]{24}$"),
+        ],
         states={
             SELECT_TASK: [CallbackQueryHandler(select_task, pattern="^edit_")],
-            SELECT_FIELD: [CallbackQueryHandler(select_field, pattern="^edit_(title|description|due_date)")],
+            SELECT_FIELD: [CallbackQueryHandler(select_field, pattern="^edit_(title|description|due_date|recurrence)")],
             EDIT_FIELD: [MessageHandler(filters.TEXT & ~filters.COMMAND, edit_field)]
         },
         fallbacks=[CommandHandler("cancel", cancel_edit)]
     )
 
+    # /select, whose Pomodoro action continues with the Pomodoro questions
+    select_handler = ConversationHandler(
+        name="select",
+        persistent=True,
+        allow_reentry=True,
+        entry_points=[CommandHandler("select", select_tasks)],
+        states={
+            SELECTING: [CallbackQueryHandler(selection_callback, pattern="^bs:")],
+            RESCHEDULE: [MessageHandler(filters.TEXT & ~filters.COMMAND, reschedule_selection)],
+            NUM_SESSIONS: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_num_sessions)],
+            WORK_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_work_time)],
+            BREAK_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_break_time)]
+        },
+        fallbacks=[CommandHandler("cancel", cancel)]
+    )
+
+    import_handler = ConversationHandler(
+        name="import",
+        persistent=True,
+        entry_points=[CommandHandler("import", import_start)],
+        states={
+            IMPORT_FILE: [MessageHandler(filters.Document.ALL, import_file)]
+        },
+        fallbacks=[CommandHandler("cancel", cancel)]
+    )
+
     # HANDLERS
+    # Conversation states are loaded per user, before any conversation sees the update
+    application.add_handler(persistence.handler(), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("tasks", list_tasks))
     application.add_handler(CommandHandler("stats", show_stats))
+    application.add_handler(CommandHandler("report", show_report))
     application.add_handler(CommandHandler("settings", show_settings))
     application.add_handler(CommandHandler("stop", stop_pomodoro))
     application.add_handler(task_handler)
@@ -719,15 +1233,32 @@ def main():
     application.add_handler(CommandHandler("done", show_mark_done_tasks))
     application.add_handler(CallbackQueryHandler(mark_done_callback, pattern="^done_"))
     application.add_handler(CommandHandler("completed_tasks", show_completed_tasks))
+    application.add_handler(CallbackQueryHandler(turn_page, pattern="^pg:"))
+    application.add_handler(CallbackQueryHandler(turn_archive_page, pattern="^ar:"))
+    application.add_handler(CommandHandler("search", search))
+    application.add_handler(CallbackQueryHandler(turn_search_page, pattern="^sr:"))
 
     application.add_handler(edit_task_handler)
+    application.add_handler(select_handler)
+    application.add_handler(import_handler)
+    application.add_handler(CommandHandler("export", export_data))
+    application.add_handler(CommandHandler("broadcast", broadcast))
+    application.add_handler(CommandHandler("broadcast_cancel", cancel_broadcast))
 
+    # Latency histograms per handler and conversation state, served on METRICS_PORT
+    instrument_handlers(application)
+    return application
 
-    application.run_polling()
+def main():
+    STARTUP_SECONDS.set(time.perf_counter() - STARTED, phase="imports")
+    logger.info("Imports took %.0f ms", (time.perf_counter() - STARTED) * 1000)
+    application = build_application()
+    if CLUSTER:
+        asyncio.run(run_worker(application))
+    elif WEBHOOK_URL:
+        application.run_webhook(**webhook_kwargs())
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
-
-    notification_thread = threading.Thread(target=schedule_notifications, daemon=True)
-    notification_thread.start()
-
     main()
\ No newline at end of file
@@ -0,0 +1,212 @@
+"""Admin broadcasts to every user.
+
+/broadcast stores a job in `broadcast_jobs`; a BroadcastRunner in some worker
+claims it and walks `users` in _id order, one batch at a time. Messages go
+through the OutboundLimiter at BULK priority, so a broadcast runs as fast as
+Telegram allows while replies to users still overtake it. After each batch
+the job's checkpoint, counters and lease are written in one update, so a job
+picks up after a restart (or on another worker once the lease expires)
+re-sending at most one batch. Users who blocked the bot or deleted their
+account are marked `blocked`, and later broadcasts and reminders skip them.
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+from telegram.error import BadRequest, Forbidden, TelegramError
+
+from cluster import WORKER_ID
+from db import broadcasts_collection, users_collection
+from metrics import Counter
+from outbound import BULK
+
+logger = logging.getLogger(__name__)
+
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").replace(",", " ").split()}
+BROADCAST_BATCH = 100
+BROADCAST_LEASE = timedelta(seconds=60)
+# How often idle runners look for a job to run or resume.
+POLL_INTERVAL = 15
+# Progress messages are edited at most this often.
+PROGRESS_INTERVAL = 5
+
+BROADCAST_MESSAGES = Counter("broadcast_messages_total", "Broadcast messages by outcome.", ["result"])
+
+
+def is_admin(user_id: int) -> bool:
+    return user_id in ADMIN_IDS
+
+
+async def create_job(text: str, admin_id: int, chat_id: int, progress_message_id: int) -> dict:
+    job = {
+        "text": text,
+        "created_by": admin_id,
+        "chat_id": chat_id,
+        "progress_message_id": progress_message_id,
+        "status": "running",
+        "total": await users_collection.count_documents({"blocked": {"$ne": True}}),
+        "last_user": None,
+        "sent": 0,
+        "blocked": 0,
+        "failed": 0,
+        "created_at": datetime.utcnow(),
+        "owner": None,
+        "lease_until": None,
+    }
+    await broadcasts_collection.insert_one(job)
+    return job
+
+
+async def latest_job():
+    return await broadcasts_collection.find_one({}, sort=[("_id", -1)])
+
+
+async def cancel_job():
+    """Cancel the running broadcast; returns it, or None if nothing is running."""
+    return await broadcasts_collection.find_one_and_update(
+        {"status": "running"},
+        {"$set": {"status": "cancelled", "finished_at": datetime.utcnow()}},
+        sort=[("_id", -1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def progress_text(job: dict, rate: float = None) -> str:
+    done = job["sent"] + job["blocked"] + job["failed"]
+    icon = {"running": "📣", "done": "✅", "cancelled": "🛑"}[job["status"]]
+    text = (
+        f"{icon} Broadcast {job['status']}: {done}/{job['total']} users\n"
+        f"📨 sent {job['sent']} · 🚫 blocked {job['blocked']} · ⚠️ failed {job['failed']}"
+    )
+    if rate is not None:
+        text += f"\n⚡ {rate:.1f} messages/s"
+    return text
+
+
+class BroadcastRunner:
+    """Claim running broadcast jobs and send them, one job at a time per worker."""
+
+    def __init__(self):
+        self._bot = None
+        self._runner = None
+        self._job_id = None
+
+    async def _claim(self):
+        now = datetime.utcnow()
+        return await broadcasts_collection.find_one_and_update(
+            {"status": "running", "$or": [{"owner": None}, {"lease_until": {"$lt": now}}]},
+            {"$set": {"owner": WORKER_ID, "lease_until": now + BROADCAST_LEASE}},
+            sort=[("_id", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def _send(self, user_id: int, text: str) -> str:
+        try:
+            await self._bot.send_message(chat_id=user_id, text=text, rate_limit_args=BULK)
+            return "sent"
+        except Forbidden:
+            # Blocked the bot, or the account was deleted.
+            return "blocked"
+        except BadRequest as e:
+            if "chat not found" in str(e).lower():
+                return "blocked"
+            logger.warning("Broadcast to %s failed: %s", user_id, e)
+            return "failed"
+        except TelegramError as e:
+            logger.warning("Broadcast to %s failed: %s", user_id, e)
+            return "failed"
+
+    async def _report(self, job: dict, rate: float = None) -> None:
+        try:
+            await self._bot.edit_message_text(
+                chat_id=job["chat_id"], message_id=job["progress_message_id"], text=progress_text(job, rate)
+            )
+        except TelegramError as e:
+            logger.debug("Broadcast progress not updated: %s", e)
+
+    async def run_job(self, job: dict) -> None:
+        started = time.monotonic()
+        reported = started
+        processed = 0
+        while True:
+            query = {"blocked": {"$ne": True}}
+            if job["last_user"] is not None:
+                query["_id"] = {"$gt": job["last_user"]}
+            users = await users_collection.find(query, {"user_id": 1}).sort("_id", 1).limit(BROADCAST_BATCH).to_list(None)
+            if not users:
+                job = await broadcasts_collection.find_one_and_update(
+                    {"_id": job["_id"], "owner": WORKER_ID, "status": "running"},
+                    {"$set": {"status": "done", "finished_at": datetime.utcnow(), "owner": None}},
+                    return_document=ReturnDocument.AFTER,
+                )
+                if job:
+                    await self._report(job, processed / max(time.monotonic() - started, 1e-9))
+                return
+
+            results = await asyncio.gather(*(self._send(user["user_id"], job["text"]) for user in users))
+            counts = {"sent": 0, "blocked": 0, "failed": 0}
+            for result in results:
+                counts[result] += 1
+                BROADCAST_MESSAGES.inc(result=result)
+            blocked = [user["_id"] for user, result in zip(users, results) if result == "blocked"]
+            if blocked:
+                await users_collection.update_many(
+                    {"_id": {"$in": blocked}}, {"$set": {"blocked": True, "blocked_at": datetime.utcnow()}}
+                )
+
+            # Checkpoint, counters and lease in one write; losing the lease or a
+            # cancel stops the job here.
+            job = await broadcasts_collection.find_one_and_update(
+                {"_id": job["_id"], "owner": WORKER_ID, "status": "running"},
+                {
+                    "$set": {"last_user": users[-1]["_id"], "lease_until": datetime.utcnow() + BROADCAST_LEASE},
+                    "$inc": counts,
+                },
+                return_document=ReturnDocument.AFTER,
+            )
+            processed += len(users)
+            if job is None:
+                logger.info("Broadcast stopped: cancelled or taken over")
+                return
+            if time.monotonic() - reported >= PROGRESS_INTERVAL:
+                reported = time.monotonic()
+                await self._report(job, processed / (reported - started))
+
+    async def run(self) -> None:
+        while True:
+            try:
+                job = await self._claim()
+                if job:
+                    self._job_id = job["_id"]
+                    logger.info("Running broadcast %s from %s", job["_id"], job["last_user"] or "the start")
+                    await self.run_job(job)
+                    self._job_id = None
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Broadcast failed, retrying")
+            await asyncio.sleep(POLL_INTERVAL)
+
+    def start(self, bot) -> None:
+        self._bot = bot
+        self._runner = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if not self._runner:
+            return
+        self._runner.cancel()
+        try:
+            await self._runner
+        except asyncio.CancelledError:
+            pass
+        self._runner = None
+        if self._job_id:
+            # Let another worker (or the next start) resume without waiting for the lease.
+            await broadcasts_collection.update_one(
+                {"_id": self._job_id, "owner": WORKER_ID}, {"$set": {"owner": None}}
+            )
+            self._job_id = None
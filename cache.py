@@ -0,0 +1,104 @@
+import time
+from collections import OrderedDict
+
+from metrics import Counter, Gauge
+
+CACHE_HITS = Counter("cache_hits_total", "Lookups answered from the cache.", ["cache"])
+CACHE_MISSES = Counter("cache_misses_total", "Lookups that missed the cache.", ["cache"])
+CACHE_SIZE = Gauge("cache_entries", "Entries held in the cache.", ["cache"])
+
+
+class TTLCache:
+    """LRU cache whose entries also expire `ttl` seconds after being set."""
+
+    def __init__(self, name: str, maxsize: int = 10000, ttl: float = 60):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        CACHE_HITS.track(lambda: self.hits, cache=name)
+        CACHE_MISSES.track(lambda: self.misses, cache=name)
+        CACHE_SIZE.track(self.__len__, cache=name)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def peek(self, key, default=None):
+        """Like get, but without counting the lookup or refreshing its LRU position."""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return default
+        return entry[1]
+
+    def set(self, key, value) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def values(self) -> list:
+        return [value for _, value in self._entries.values()]
+
+    def invalidate(self, key) -> None:
+        self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class VersionedCache:
+    """Values cached per user, stamped with a version of that user's data.
+
+    Every write to the data calls `bump`, which moves the user's version on
+    and drops their values. A value computed from data read before a bump is
+    not stored, so a slow computation cannot bring back a stale value.
+    """
+
+    def __init__(self, name: str, maxsize: int = 10000, ttl: float = 300, max_values: int = 20):
+        self._users = TTLCache(name, maxsize=maxsize, ttl=ttl)
+        self.max_values = max_values
+
+    def entry(self, user_id: int) -> dict:
+        """The user's {"version", "values"}; read the version before computing a value."""
+        entry = self._users.get(user_id)
+        if entry is None:
+            entry = {"version": 0, "values": {}}
+            self._users.set(user_id, entry)
+        return entry
+
+    def store(self, entry: dict, version: int, key, value) -> None:
+        if entry["version"] != version:
+            return
+        if len(entry["values"]) >= self.max_values:
+            del entry["values"][next(iter(entry["values"]))]
+        entry["values"][key] = value
+
+    def bump(self, user_id: int) -> None:
+        entry = self._users.peek(user_id)
+        if entry is not None:
+            entry["version"] += 1
+            entry["values"].clear()
+
+    def clear(self) -> None:
+        for entry in self._users.values():
+            entry["version"] += 1
+            entry["values"].clear()
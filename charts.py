@@ -0,0 +1,35 @@
+"""Charts for /report, drawn in the report process pool.
+
+Pool workers import this module on their own, so it imports nothing from the
+bot and only pulls in matplotlib when the first chart is drawn.
+"""
+import io
+
+
+def render_report_chart(labels: list, focus: list, completed: list, title: str) -> bytes:
+    """Focus minutes as bars and completed tasks as a line, as PNG bytes."""
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib.figure import Figure
+
+    figure = Figure(figsize=(8, 4), dpi=100)
+    focus_axis = figure.subplots()
+    positions = range(len(labels))
+    focus_axis.bar(positions, focus, color="#e8553f", label="Focus (min)")
+    focus_axis.set_ylabel("Focus minutes")
+    focus_axis.set_title(title)
+
+    tasks_axis = focus_axis.twinx()
+    tasks_axis.plot(positions, completed, color="#2f7d32", marker="o", markersize=3, label="Tasks done")
+    tasks_axis.set_ylabel("Tasks completed")
+    tasks_axis.set_ylim(bottom=0)
+
+    step = max(1, len(labels) // 8)
+    focus_axis.set_xticks(list(positions)[::step])
+    focus_axis.set_xticklabels(labels[::step], rotation=30, ha="right", fontsize=8)
+    figure.legend(loc="upper left", fontsize=8)
+    figure.tight_layout()
+
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format="png")
+    return buffer.getvalue()
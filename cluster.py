@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import math
+import os
+import random
+import socket
+from datetime import datetime, timedelta
+
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from db import leases_collection, workers_collection
+
+logger = logging.getLogger(__name__)
+
+# Set CLUSTER=1 to run several bot processes against the same database.
+CLUSTER = os.getenv("CLUSTER", "0") == "1"
+NUM_PARTITIONS = int(os.getenv("PARTITIONS", "64"))
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+LEASE_TTL = timedelta(seconds=15)
+RENEW_INTERVAL = 5
+POLLER_LEASE = "poller"
+
+
+def partition_of(user_id: int) -> int:
+    return user_id % NUM_PARTITIONS
+
+
+def partition_filter(partitions) -> dict:
+    """Query filter matching documents whose user_id falls in `partitions`."""
+    return {"$expr": {"$in": [{"$mod": ["$user_id", NUM_PARTITIONS]}, sorted(partitions)]}}
+
+
+class PartitionManager:
+    """Share the user partitions, and the right to poll, between live workers.
+
+    Every worker heartbeats into `workers` and holds leases in `worker_leases`
+    for at most its fair share of NUM_PARTITIONS. Leases of a worker that
+    stops renewing expire after LEASE_TTL and are claimed by the others.
+    Without `on_poller_change` (webhook mode) the poller lease is left alone.
+    """
+
+    def __init__(self, on_acquire, on_release, on_poller_change=None):
+        self._on_acquire = on_acquire
+        self._on_release = on_release
+        self._on_poller_change = on_poller_change
+        self.owned = set()
+        self.polling = False
+        self._runner = None
+
+    async def _heartbeat(self, now: datetime) -> int:
+        await workers_collection.update_one(
+            {"_id": WORKER_ID},
+            {"$set": {"expires_at": now + LEASE_TTL}},
+            upsert=True,
+        )
+        return await workers_collection.count_documents({"expires_at": {"$gt": now}})
+
+    async def _renew(self, now: datetime) -> set:
+        keys = list(self.owned) + ([POLLER_LEASE] if self.polling else [])
+        await leases_collection.update_many(
+            {"_id": {"$in": keys}, "owner": WORKER_ID},
+            {"$set": {"expires_at": now + LEASE_TTL}},
+        )
+        return {
+            lease["_id"]
+            async for lease in leases_collection.find({"_id": {"$in": keys}, "owner": WORKER_ID}, {"_id": 1})
+        }
+
+    async def _claim(self, key, now: datetime) -> bool:
+        lease = await leases_collection.find_one_and_update(
+            {"_id": key, "$or": [{"owner": None}, {"expires_at": {"$lte": now}}]},
+            {"$set": {"owner": WORKER_ID, "expires_at": now + LEASE_TTL}},
+        )
+        return lease is not None
+
+    async def _release(self, keys) -> None:
+        await leases_collection.update_many(
+            {"_id": {"$in": list(keys)}, "owner": WORKER_ID},
+            {"$set": {"owner": None}},
+        )
+
+    async def _rebalance(self) -> None:
+        now = datetime.utcnow()
+        live_workers = max(1, await self._heartbeat(now))
+        held = await self._renew(now)
+
+        lost = self.owned - held
+        if lost:
+            logger.warning("Lost %d partition leases", len(lost))
+        if self.polling and POLLER_LEASE not in held:
+            self.polling = False
+            await self._on_poller_change(False)
+        if self._on_poller_change and not self.polling and await self._claim(POLLER_LEASE, now):
+            self.polling = True
+            await self._on_poller_change(True)
+
+        owned = self.owned - lost
+        share = math.ceil(NUM_PARTITIONS / live_workers)
+        released = set()
+        if len(owned) > share:
+            released = set(random.sample(sorted(owned), len(owned) - share))
+            await self._release(released)
+            owned -= released
+
+        acquired = set()
+        if len(owned) < share:
+            free = [
+                lease["_id"]
+                async for lease in leases_collection.find(
+                    {"_id": {"$ne": POLLER_LEASE}, "$or": [{"owner": None}, {"expires_at": {"$lte": now}}]},
+                    {"_id": 1},
+                )
+            ]
+            random.shuffle(free)
+            for partition in free[:share - len(owned)]:
+                if await self._claim(partition, now):
+                    acquired.add(partition)
+
+        self.owned = owned | acquired
+        if lost | released:
+            await self._on_release(lost | released)
+        if acquired:
+            logger.info("Acquired partitions %s", sorted(acquired))
+            await self._on_acquire(acquired)
+
+    async def run(self) -> None:
+        try:
+            await leases_collection.insert_many(
+                [{"_id": partition, "owner": None, "expires_at": datetime.min}
+                 for partition in range(NUM_PARTITIONS)]
+                + [{"_id": POLLER_LEASE, "owner": None, "expires_at": datetime.min}],
+                ordered=False,
+            )
+        except BulkWriteError:
+            pass  # Another worker created them first.
+
+        while True:
+            try:
+                await self._rebalance()
+            except PyMongoError:
+                logger.exception("Partition rebalance failed")
+            await asyncio.sleep(RENEW_INTERVAL)
+
+    def start(self) -> None:
+        self._runner = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._runner:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+        # Hand everything back straight away instead of waiting for expiry.
+        await self._release(list(self.owned) + [POLLER_LEASE])
+        await workers_collection.delete_one({"_id": WORKER_ID})
+
+
+async def follow_changes(collection, on_change, pre_images: bool = False) -> None:
+    """Feed every change to `collection` into `on_change`, resuming after errors.
+
+    With `pre_images`, changes carry the document as it was before them if
+    the collection has pre-images enabled (init_db does that for tasks on
+    MongoDB 6.0+). Older servers reject the option, so it is only asked for
+    when the collection's options show them on.
+    """
+    resume_token = None
+    while True:
+        try:
+            before_change = None
+            if pre_images:
+                options = await collection.options()
+                if options.get("changeStreamPreAndPostImages", {}).get("enabled"):
+                    before_change = "whenAvailable"
+            async with await collection.watch(
+                full_document="updateLookup",
+                full_document_before_change=before_change,
+                resume_after=resume_token,
+            ) as stream:
+                async for change in stream:
+                    resume_token = stream.resume_token
+                    await on_change(change)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Change stream on %s failed, reconnecting", collection.name)
+            await asyncio.sleep(1)
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+
+from telegram.error import BadRequest, TelegramError
+
+from metrics import Counter, Gauge
+from outbound import BULK
+
+logger = logging.getLogger(__name__)
+
+# Status messages are refreshed in passes this many seconds apart...
+PASS_SECONDS = float(os.getenv("COUNTDOWN_PASS_SECONDS", "5"))
+# ...and all sessions together get at most this many edits a second, leaving
+# most of Telegram's ~30 messages/s for replies and notifications.
+EDIT_RATE = float(os.getenv("COUNTDOWN_EDITS_PER_SECOND", "5"))
+
+COUNTDOWN_EDITS = Counter("pomodoro_countdown_edits_total", "Status message edits sent.", ["result"])
+COUNTDOWN_BACKLOG = Gauge("pomodoro_countdown_backlog", "Status messages that were out of date at the last pass.")
+
+
+class CountdownEditor:
+    """Keep the status message of every session in `sessions` up to date.
+
+    Edits are coalesced: each pass renders every session's text with
+    `render(session_data, now)` and only edits the messages whose text
+    changed since they were last shown. Each pass
+    sends at most EDIT_RATE * PASS_SECONDS edits at BULK priority, the
+    messages edited longest ago first, so with many sessions each message is
+    refreshed less often instead of the bot running into rate limits.
+    """
+
+    def __init__(self, sessions: dict, render, rate: float = EDIT_RATE, pass_seconds: float = PASS_SECONDS):
+        self.sessions = sessions
+        self.render = render
+        self.budget = max(1, int(rate * pass_seconds))
+        self.pass_seconds = pass_seconds
+        self._shown = {}
+        self._edited_at = {}
+        self._final = {}
+        self._bot = None
+        self._runner = None
+
+    def shown(self, session_data: dict, text: str) -> None:
+        """Record that a session's status message was just sent showing `text`."""
+        self._shown[session_data["user_id"]] = (session_data["status_message_id"], text)
+        self._edited_at[session_data["user_id"]] = time.monotonic()
+
+    def finish(self, session_data: dict, text: str) -> None:
+        """Replace a session's status message with `text` on the next pass."""
+        message_id = session_data.get("status_message_id")
+        if message_id:
+            self._final[(session_data["chat_id"], message_id)] = text
+
+    def _pending_edits(self, now: datetime) -> list:
+        """(chat_id, message_id, text, user_id) of every out-of-date message, most urgent first."""
+        edits = [(chat_id, message_id, text, None) for (chat_id, message_id), text in self._final.items()]
+        stale = []
+        for user_id, session_data in self.sessions.items():
+            if not session_data.get("status_message_id"):
+                continue
+            text = self.render(session_data, now)
+            if self._shown.get(user_id) != (session_data["status_message_id"], text):
+                stale.append((self._edited_at.get(user_id, 0), user_id, session_data, text))
+        stale.sort(key=lambda entry: entry[:2])
+        edits += [
+            (session_data["chat_id"], session_data["status_message_id"], text, user_id)
+            for _, user_id, session_data, text in stale
+        ]
+        return edits
+
+    async def _edit(self, chat_id: int, message_id: int, text: str, user_id) -> None:
+        try:
+            await self._bot.edit_message_text(
+                chat_id=chat_id, message_id=message_id, text=text, rate_limit_args=BULK
+            )
+            COUNTDOWN_EDITS.inc(result="ok")
+        except BadRequest as e:
+            # Deleted, too old to edit or already showing this text: not worth retrying.
+            COUNTDOWN_EDITS.inc(result="rejected")
+            logger.debug("Status message %s in %s not edited: %s", message_id, chat_id, e)
+        except TelegramError as e:
+            COUNTDOWN_EDITS.inc(result="failed")
+            logger.warning("Failed to edit status message: %s", e)
+            return
+        if user_id is not None:
+            self._shown[user_id] = (message_id, text)
+            self._edited_at[user_id] = time.monotonic()
+
+    async def refresh(self) -> None:
+        """Run one pass."""
+        for user_id in [user_id for user_id in self._shown if user_id not in self.sessions]:
+            del self._shown[user_id]
+            self._edited_at.pop(user_id, None)
+
+        edits = self._pending_edits(datetime.utcnow())
+        COUNTDOWN_BACKLOG.set(len(edits))
+        edits = edits[:self.budget]
+        for chat_id, message_id, _, _ in edits:
+            self._final.pop((chat_id, message_id), None)
+        await asyncio.gather(*(self._edit(*edit) for edit in edits))
+
+    async def run(self) -> None:
+        while True:
+            started = time.monotonic()
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("Countdown pass failed")
+            await asyncio.sleep(max(0, self.pass_seconds - (time.monotonic() - started)))
+
+    def start(self, bot) -> None:
+        self._bot = bot
+        self._runner = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._runner:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import os
+
+from dotenv import load_dotenv
+from pymongo import AsyncMongoClient
+from pymongo.errors import OperationFailure
+
+from metrics import MongoCommandMetrics
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# MONGO DB SETUP
+MONGO_URI = os.getenv("MONGO_URI")
+DB_NAME = os.getenv("MONGO_DB", "telegram_bot")
+
+# COLLECTIONS
+COLLECTIONS = {
+    "users": "users",
+    "tasks": "tasks",
+    "pomodoro_sessions": "pomodoro_sessions",
+    "user_settings": "user_settings",
+    "statistics": "statistics",
+    "daily_stats": "daily_stats",
+    "pomodoro_timers": "pomodoro_timers",
+    "workers": "workers",
+    "worker_leases": "worker_leases",
+    "conversation_state": "conversation_state",
+    "tasks_archive": "tasks_archive",
+    "pomodoro_sessions_archive": "pomodoro_sessions_archive",
+    "broadcast_jobs": "broadcast_jobs",
+}
+
+# AsyncMongoClient runs on the bot's event loop, so a slow query only
+# suspends the handler that issued it instead of blocking every update.
+client = AsyncMongoClient(MONGO_URI, event_listeners=[MongoCommandMetrics()])
+db = client[DB_NAME]
+
+users_collection = db[COLLECTIONS["users"]]
+tasks_collection = db[COLLECTIONS["tasks"]]
+pomodoro_collection = db[COLLECTIONS["pomodoro_sessions"]]
+settings_collection = db[COLLECTIONS["user_settings"]]
+stats_collection = db[COLLECTIONS["statistics"]]
+daily_stats_collection = db[COLLECTIONS["daily_stats"]]
+timers_collection = db[COLLECTIONS["pomodoro_timers"]]
+workers_collection = db[COLLECTIONS["workers"]]
+leases_collection = db[COLLECTIONS["worker_leases"]]
+conversations_collection = db[COLLECTIONS["conversation_state"]]
+task_archive_collection = db[COLLECTIONS["tasks_archive"]]
+session_archive_collection = db[COLLECTIONS["pomodoro_sessions_archive"]]
+broadcasts_collection = db[COLLECTIONS["broadcast_jobs"]]
+
+
+async def init_db():
+    """Create the indexes behind every query the bot issues.
+
+    `python query_plans.py` explains those queries against a scratch database
+    and fails if one of them stops using these indexes.
+    """
+    # user_id used to be a plain index, so concurrent first /start calls could
+    # leave duplicate users behind; keep the oldest of each before making it unique.
+    old = (await users_collection.index_information()).get("user_id_1")
+    if old and not old.get("unique"):
+        async for group in await users_collection.aggregate([
+            {"$group": {"_id": "$user_id", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}},
+        ]):
+            await users_collection.delete_many({"_id": {"$in": sorted(group["ids"])[1:]}})
+        await users_collection.drop_index("user_id_1")
+    await asyncio.gather(
+        users_collection.create_index("user_id", unique=True),
+        # Task pages: equality on user_id and status, keyset order on (due_date, _id).
+        tasks_collection.create_index([("user_id", 1), ("status", 1), ("due_date", 1), ("_id", 1)]),
+        # Reminder windows scan pending tasks by due date across all users.
+        tasks_collection.create_index(
+            "due_date",
+            name="pending_due_date",
+            partialFilterExpression={"status": "pending"},
+        ),
+        # /search: text search within one user's tasks, titles weighted above descriptions.
+        tasks_collection.create_index(
+            [("user_id", 1), ("title", "text"), ("description", "text")],
+            name="task_search",
+            weights={"title": 3, "description": 1},
+        ),
+        # Archival scans completed tasks and sessions oldest first, across all users.
+        tasks_collection.create_index(
+            [("completed_at", 1), ("_id", 1)],
+            name="completed_at_id",
+            partialFilterExpression={"status": "completed"},
+        ),
+        # Completions upsert the next occurrence of a recurring task by its place in the series.
+        tasks_collection.create_index(
+            [("series_id", 1), ("occurrence", 1)],
+            name="series_occurrence",
+            unique=True,
+            partialFilterExpression={"series_id": {"$exists": True}},
+        ),
+        pomodoro_collection.create_index([("user_id", 1), ("start_time", -1)]),
+        pomodoro_collection.create_index([("start_time", 1), ("_id", 1)]),
+        task_archive_collection.create_index([("user_id", 1), ("end", -1), ("_id", -1)]),
+        session_archive_collection.create_index([("user_id", 1), ("end", -1), ("_id", -1)]),
+        settings_collection.create_index("user_id", unique=True),
+        stats_collection.create_index("user_id", unique=True),
+        daily_stats_collection.create_index([("user_id", 1), ("day", 1)], unique=True),
+        timers_collection.create_index("user_id", unique=True),
+        workers_collection.create_index("expires_at"),
+        leases_collection.create_index("owner"),
+        leases_collection.create_index("expires_at"),
+    )
+    # Superseded by the (user_id, status, due_date, _id) index.
+    if "user_id_1_due_date_1" in await tasks_collection.index_information():
+        await tasks_collection.drop_index("user_id_1_due_date_1")
+    # Lets change streams on tasks carry deleted tasks (MongoDB 6.0+), so the
+    # page cache drops only their owner's pages.
+    try:
+        await db.command("collMod", tasks_collection.name, changeStreamPreAndPostImages={"enabled": True})
+    except OperationFailure as e:
+        logger.warning("Change stream pre-images are off for tasks: %s", e)
+
+
+async def ping_db():
+    """Open the first connection (DNS, TLS, auth) before a handler needs it."""
+    await client.admin.command("ping")
+
+
+async def close_db():
+    await client.close()
@@ -0,0 +1,80 @@
+import asyncio
+import os
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Set WEBHOOK_URL to receive updates through a webhook instead of long polling.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+
+
+def webhook_kwargs() -> dict:
+    """Arguments for Updater.start_webhook / Application.run_webhook.
+
+    Telegram echoes WEBHOOK_SECRET in every request's secret-token header and
+    the embedded server rejects requests without it. Without a secret anyone
+    could post updates, so webhook mode refuses to start.
+    """
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET must be set when WEBHOOK_URL is")
+    return {
+        "listen": WEBHOOK_LISTEN,
+        "port": WEBHOOK_PORT,
+        "url_path": WEBHOOK_PATH,
+        "webhook_url": f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+        "secret_token": WEBHOOK_SECRET,
+        "allowed_updates": Update.ALL_TYPES,
+    }
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Process up to `max_concurrent_updates` updates at once, one at a time per user.
+
+    Updates from different users run concurrently, while a user's own updates
+    keep their order so their conversations cannot race each other. That
+    only holds within this process: with several webhook workers, each
+    user's updates have to be routed to the same one.
+    """
+
+    def __init__(self, max_concurrent_updates: int = MAX_CONCURRENT_UPDATES):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}
+
+    async def process_update(self, update, coroutine) -> None:
+        """Wait for the user's earlier updates, then for one of the shared slots.
+
+        A user's queued updates wait on their own lock without holding a slot,
+        so one user's backlog cannot stall everybody else.
+        """
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await super().process_update(update, coroutine)
+            return
+
+        lock, waiters = self._locks.get(user.id, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._locks[user.id] = (lock, waiters + 1)
+        try:
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            lock, waiters = self._locks[user.id]
+            if waiters == 1:
+                del self._locks[user.id]
+            else:
+                self._locks[user.id] = (lock, waiters - 1)
+
+    async def do_process_update(self, update, coroutine) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
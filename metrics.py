@@ -0,0 +1,297 @@
+"""Prometheus metrics and an optional sampling profiler.
+
+Modules declare their metrics here at import time. Set METRICS_PORT to serve
+them in the Prometheus text format at /metrics. Set PROFILE_INTERVAL (seconds
+between samples, e.g. 0.005) to also sample the event loop's stack from a
+background thread. /profile then returns the samples as folded stacks for
+flamegraph.pl or speedscope.
+"""
+import asyncio
+import bisect
+import collections
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+
+from pymongo import monitoring
+from telegram.ext import CommandHandler, ConversationHandler
+
+logger = logging.getLogger(__name__)
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0"))
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REGISTRY = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._callbacks = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def track(self, callback, **labels) -> None:
+        """Read the value from `callback()` at every scrape instead of storing it."""
+        self._callbacks[self._key(labels)] = callback
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        values = dict(self._values)
+        for key, callback in self._callbacks.items():
+            values[key] = callback()
+        for key, value in values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        series = self._values.get(key)
+        if series is None:
+            # Per-bucket (not yet cumulative) counts, then the sum.
+            series = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for key, series in list(self._values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {series[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+# HANDLERS
+HANDLER_SECONDS = Histogram(
+    "bot_handler_seconds", "Time spent in each handler callback.",
+    ["handler", "conversation", "state"],
+)
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total", "Handler callbacks that raised.",
+    ["handler", "conversation", "state"],
+)
+
+
+def _timed(handler, conversation: str, state: str) -> None:
+    callback = handler.callback
+    if isinstance(handler, CommandHandler):
+        name = "/" + ",".join(sorted(handler.commands))
+    else:
+        name = getattr(callback, "__name__", type(handler).__name__)
+    labels = {"handler": name, "conversation": conversation, "state": state}
+
+    @functools.wraps(callback)
+    async def timed_callback(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(**labels)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, **labels)
+
+    handler.callback = timed_callback
+
+
+def instrument_handlers(application) -> None:
+    """Time every handler of `application`, including those inside conversations.
+
+    Handlers in a ConversationHandler are labelled with its name and the
+    state they serve ("entry" and "fallback" for the entry points and fallbacks).
+    """
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if not isinstance(handler, ConversationHandler):
+                _timed(handler, "", "")
+                continue
+            groups = [("entry", handler.entry_points), *handler.states.items(), ("fallback", handler.fallbacks)]
+            for state, state_handlers in groups:
+                for state_handler in state_handlers:
+                    _timed(state_handler, handler.name or "", str(state))
+
+
+# MONGO
+MONGO_COMMAND_SECONDS = Histogram(
+    "mongo_command_seconds", "Round trip time of each Mongo command.", ["command", "collection"],
+)
+MONGO_COMMAND_ERRORS = Counter(
+    "mongo_command_errors_total", "Mongo commands that failed.", ["command", "collection"],
+)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Feed pymongo command monitoring into MONGO_COMMAND_SECONDS."""
+
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event):
+        field = "collection" if event.command_name == "getMore" else event.command_name
+        collection = event.command.get(field)
+        self._collections[(event.connection_id, event.request_id)] = (
+            collection if isinstance(collection, str) else ""
+        )
+
+    def succeeded(self, event):
+        self._observe(event)
+
+    def failed(self, event):
+        collection = self._observe(event)
+        MONGO_COMMAND_ERRORS.inc(command=event.command_name, collection=collection)
+
+    def _observe(self, event) -> str:
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        MONGO_COMMAND_SECONDS.observe(
+            event.duration_micros / 1e6, command=event.command_name, collection=collection
+        )
+        return collection
+
+
+# PROFILER
+class SamplingProfiler:
+    """Record the event loop thread's stack every `interval` seconds.
+
+    Sampling happens on a separate thread, so it also catches the loop while
+    a handler blocks it.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples = collections.Counter()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._target = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+                frame = frame.f_back
+            if stack:
+                with self._lock:
+                    self.samples[";".join(reversed(stack))] += 1
+
+    def folded(self) -> str:
+        with self._lock:
+            samples = self.samples.most_common()
+        return "".join(f"{stack} {count}\n" for stack, count in samples)
+
+    def start(self) -> None:
+        self._target = threading.get_ident()
+        threading.Thread(target=self._run, name="sampling-profiler", daemon=True).start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+
+# ENDPOINT
+class MetricsServer:
+    """Serve /metrics (and /profile when profiling) over plain HTTP."""
+
+    def __init__(self, port: int = METRICS_PORT, host: str = METRICS_HOST,
+                 profile_interval: float = PROFILE_INTERVAL):
+        self.port = port
+        self.host = host
+        self.profiler = SamplingProfiler(profile_interval) if profile_interval > 0 else None
+        self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            path = parts[1].split("?")[0] if len(parts) > 1 else ""
+
+            if path == "/metrics":
+                status, body = "200 OK", render()
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            elif path == "/profile" and self.profiler:
+                status, body, content_type = "200 OK", self.profiler.folded(), "text/plain; charset=utf-8"
+            else:
+                status, body, content_type = "404 Not Found", "not found\n", "text/plain; charset=utf-8"
+
+            payload = body.encode()
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode()
+                + payload
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        if self.profiler:
+            self.profiler.start()
+        logger.info("Serving metrics on %s:%d", self.host, self.port)
+
+    async def stop(self) -> None:
+        if self.profiler:
+            self.profiler.stop()
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
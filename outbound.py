@@ -0,0 +1,177 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+# Priorities passed as `rate_limit_args`; lower values are sent first.
+URGENT = 0
+BULK = 1
+
+# Telegram's documented limits: ~30 messages/s overall, about one message a
+# second to the same private chat and 20 messages a minute to the same group.
+OVERALL_RATE = 30
+PRIVATE_CHAT_RATE = 1
+GROUP_CHAT_RATE = 20 / 60
+
+QUEUE_SECONDS = Histogram(
+    "telegram_queue_seconds", "Time Bot API requests waited for the rate limiter.", ["priority"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300),
+)
+REQUEST_SECONDS = Histogram("telegram_request_seconds", "Bot API request round trip time.", ["endpoint"])
+RETRY_AFTER = Counter("telegram_retry_after_total", "Bot API requests answered with a 429.", ["endpoint"])
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Seconds until a token is available."""
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self):
+        while (delay := self.delay()) > 0:
+            await asyncio.sleep(delay)
+        self.take()
+
+
+class OutboundLimiter(BaseRateLimiter[int]):
+    """Throttle every Bot API request the application makes.
+
+    Requests first wait for their chat's bucket, then queue for the overall
+    bucket, which hands out tokens in priority order so replies to users
+    overtake queued reminders. A 429 pauses all sending for `retry_after`
+    and the request is retried with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        overall_rate: float = OVERALL_RATE,
+        private_chat_rate: float = PRIVATE_CHAT_RATE,
+        group_chat_rate: float = GROUP_CHAT_RATE,
+        max_retries: int = 5,
+    ):
+        self._overall = TokenBucket(overall_rate, overall_rate)
+        self._private_chat_rate = private_chat_rate
+        self._group_chat_rate = group_chat_rate
+        self._max_retries = max_retries
+        self._chats = {}
+        self._waiters = []
+        self._counter = itertools.count()
+        self._waiting = asyncio.Event()
+        self._paused_until = 0.0
+        self._gate = None
+
+    async def initialize(self) -> None:
+        self._gate = asyncio.create_task(self._run_gate())
+
+    async def shutdown(self) -> None:
+        if self._gate:
+            self._gate.cancel()
+            try:
+                await self._gate
+            except asyncio.CancelledError:
+                pass
+            self._gate = None
+        for _, _, waiter in self._waiters:
+            waiter.cancel()
+        self._waiters.clear()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                self._chats = {key: value for key, value in self._chats.items() if not value.full}
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(self._group_chat_rate, 3)
+            else:
+                bucket = TokenBucket(self._private_chat_rate, 3)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _run_gate(self):
+        while True:
+            await self._waiting.wait()
+            while self._waiters:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                    continue
+                delay = self._overall.delay()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                _, _, waiter = heapq.heappop(self._waiters)
+                if waiter.done():
+                    continue
+                self._overall.take()
+                waiter.set_result(None)
+            self._waiting.clear()
+
+    async def _wait_for_slot(self, priority: int):
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), waiter))
+        self._waiting.set()
+        await waiter
+
+    async def _timed_request(self, endpoint: str, request):
+        started = time.perf_counter()
+        try:
+            return await request
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = URGENT if rate_limit_args is None else rate_limit_args
+        chat_id = data.get("chat_id")
+
+        for attempt in range(self._max_retries + 1):
+            queued = time.perf_counter()
+            if chat_id is not None:
+                await self._chat_bucket(chat_id).acquire()
+            await self._wait_for_slot(priority)
+            QUEUE_SECONDS.observe(time.perf_counter() - queued, priority=priority)
+            try:
+                return await self._timed_request(endpoint, callback(*args, **kwargs))
+            except RetryAfter as exc:
+                RETRY_AFTER.inc(endpoint=endpoint)
+                if attempt == self._max_retries:
+                    logger.warning("%s still rate limited after %d retries", endpoint, attempt)
+                    raise
+                retry_after = exc.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                backoff = retry_after + random.uniform(0, 2 ** attempt)
+                logger.info("%s hit a 429, retrying in %.1fs", endpoint, backoff)
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                await asyncio.sleep(backoff)
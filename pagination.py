@@ -0,0 +1,224 @@
+import os
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from cache import VersionedCache
+from db import task_archive_collection, tasks_collection
+from recurrence import describe
+
+PAGE_SIZE = 10
+
+# Page cursors travel in callback_data ("pg:<view>:<n|p>:<due_date>:<_id>"),
+# which Telegram caps at 64 bytes. /select pages use the "bs" prefix instead.
+CURSOR_DATE_FORMAT = "%Y%m%d%H%M%S%f"
+
+TEXT_FIELDS = {"title": 1, "description": 1, "due_date": 1, "recurrence": 1}
+BUTTON_FIELDS = {"title": 1, "due_date": 1}
+# Keeps a full page of tasks under Telegram's 4096-character message limit.
+MAX_DESCRIPTION = 300
+
+# Rendered pages are kept this long at most, in case tasks are changed by
+# something that neither goes through the bot nor is followed through a
+# change stream (TASK_CACHE_WATCH=1, always on with CLUSTER=1).
+PAGE_CACHE_TTL = int(os.getenv("TASK_CACHE_TTL", "300"))
+WATCH_TASKS = os.getenv("TASK_CACHE_WATCH") == "1"
+MAX_CACHED_PAGES = 20
+# Fields the bot itself updates that never show up on a page.
+UNRENDERED_FIELDS = {"reminded_for", "reminder_claim"}
+MISSING = object()
+
+
+def shorten(text: str, limit: int = MAX_DESCRIPTION) -> str:
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def format_pending(task: dict) -> str:
+    text = (
+        f"📌 {shorten(task['title'])}\n"
+        f"📝 {shorten(task.get('description', 'No description'))}\n"
+        f"📅 Due: {task['due_date'].strftime('%Y-%m-%d')}"
+    )
+    if task.get("recurrence"):
+        text += f"\n🔁 Repeats {describe(task['recurrence'])}"
+    return text
+
+
+def format_completed(task: dict) -> str:
+    return (
+        f"✅ {shorten(task['title'])}\n"
+        f"📝 {shorten(task.get('description', ''))}\n"
+        f"📅 Due: {task['due_date'].strftime('%Y-%m-%d')}\n"
+    )
+
+
+# Every paginated list, keyed by the short code used in its callback_data.
+# Text views render tasks into the message; button views render one button
+# per task whose callback_data is `button` + the task id.
+VIEWS = {
+    "t": {"status": "pending", "header": "Your tasks:\n", "format": format_pending, "separator": "\n\n"},
+    "c": {
+        "status": "completed", "header": "Your completed tasks:\n", "format": format_completed, "separator": "\n",
+        # Its last page links to the tasks moved to tasks_archive (see archive.py).
+        "archive": True,
+    },
+    "d": {"status": "pending", "header": "Select a task to mark as done:", "button": "done_"},
+    "e": {"status": "pending", "header": "Select a task to edit:", "button": "edit_"},
+    "p": {"status": "pending", "header": "Select task for session:", "button": "task_"},
+}
+
+
+class PageCache(VersionedCache):
+    """Rendered pages of each user's task lists.
+
+    Every write to a user's tasks calls `bump`; `on_change` does the same for
+    changes seen on a change stream of `tasks`, which for deletes needs the
+    pre-images `init_db` enables.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = PAGE_CACHE_TTL):
+        super().__init__("task_pages", maxsize=maxsize, ttl=ttl, max_values=MAX_CACHED_PAGES)
+
+    async def on_change(self, change: dict) -> None:
+        if change["operationType"] == "update":
+            if set(change["updateDescription"]["updatedFields"]) <= UNRENDERED_FIELDS:
+                return
+        task = change.get("fullDocument") or change.get("fullDocumentBeforeChange")
+        if task:
+            self.bump(task["user_id"])
+        else:
+            # Invalidated, or deleted without a pre-image to name the owner.
+            self.clear()
+
+
+page_cache = PageCache()
+
+
+def encode_cursor(view: str, direction: str, task: dict, prefix: str = "pg") -> str:
+    return f"{prefix}:{view}:{direction}:{task['due_date'].strftime(CURSOR_DATE_FORMAT)}:{task['_id']}"
+
+
+def decode_cursor(data: str):
+    _, view, direction, due_date, task_id = data.split(":")
+    return view, direction, (datetime.strptime(due_date, CURSOR_DATE_FORMAT), ObjectId(task_id))
+
+
+def page_query(user_id: int, status: str, direction: str = "n", cursor=None):
+    """Build the (filter, sort) of one page of a user's tasks ordered by (due_date, _id).
+
+    `cursor` is the (due_date, _id) of the task the page starts after ("n")
+    or ends before ("p"). Served by the (user_id, status, due_date, _id) index.
+    """
+    query = {"user_id": user_id, "status": status}
+    if cursor:
+        due_date, task_id = cursor
+        op = "$gt" if direction == "n" else "$lt"
+        query["$or"] = [
+            {"due_date": {op: due_date}},
+            {"due_date": due_date, "_id": {op: task_id}},
+        ]
+    order = 1 if direction == "n" else -1
+    return query, [("due_date", order), ("_id", order)]
+
+
+async def fetch_page(user_id: int, status: str, projection: dict, direction: str = "n", cursor=None):
+    """Fetch one page of a user's tasks; returns (tasks, has_prev, has_next)."""
+    query, sort = page_query(user_id, status, direction, cursor)
+    tasks = await tasks_collection.find(query, projection).sort(sort).limit(PAGE_SIZE + 1).to_list(None)
+
+    more = len(tasks) > PAGE_SIZE
+    tasks = tasks[:PAGE_SIZE]
+    if direction == "n":
+        return tasks, cursor is not None, more
+    tasks.reverse()
+    return tasks, more, True
+
+
+async def render_page(view: str, user_id: int, direction: str = "n", cursor=None):
+    """Return (text, reply_markup) for a page of `view`, or None if it is empty.
+
+    Pages come from `page_cache` while the user's tasks are unchanged.
+    """
+    entry = page_cache.entry(user_id)
+    version = entry["version"]
+    page = entry["values"].get((view, direction, cursor), MISSING)
+    if page is MISSING:
+        page = await build_page(view, user_id, direction, cursor)
+        page_cache.store(entry, version, (view, direction, cursor), page)
+    return page
+
+
+async def build_page(view: str, user_id: int, direction: str = "n", cursor=None):
+    spec = VIEWS[view]
+    projection = BUTTON_FIELDS if "button" in spec else TEXT_FIELDS
+    tasks, has_prev, has_next = await fetch_page(user_id, spec["status"], projection, direction, cursor)
+    if not tasks:
+        return None
+
+    if "button" in spec:
+        text = spec["header"]
+        keyboard = [
+            [InlineKeyboardButton(task["title"], callback_data=f"{spec['button']}{task['_id']}")]
+            for task in tasks
+        ]
+    else:
+        text = spec["header"] + spec["separator"].join(spec["format"](task) for task in tasks)
+        keyboard = []
+
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton("◀ Prev", callback_data=encode_cursor(view, "p", tasks[0])))
+    if has_next:
+        navigation.append(InlineKeyboardButton("Next ▶", callback_data=encode_cursor(view, "n", tasks[-1])))
+    elif spec.get("archive") and await task_archive_collection.find_one({"user_id": user_id}, {"_id": 1}):
+        navigation.append(InlineKeyboardButton("🗄 Archived ▶", callback_data="ar:0"))
+    if navigation:
+        keyboard.append(navigation)
+    return text, InlineKeyboardMarkup(keyboard) if keyboard else None
+
+
+# /select: a checkbox per task of the page, then the actions for the selection.
+SELECTION_ACTIONS = [
+    [("✅ Done", "done"), ("🗑 Delete", "delete")],
+    [("📅 Reschedule", "date"), ("🍅 Pomodoro", "pomodoro")],
+    [("✖ Cancel", "cancel")],
+]
+# Titles are kept in user_data for the checkboxes, so only their start.
+SELECTION_TITLE = 40
+
+
+async def fetch_selection_page(selection: dict, user_id: int, direction: str = "n", cursor=None) -> bool:
+    """Load a page of pending tasks into `selection`; False if it is empty."""
+    tasks, has_prev, has_next = await fetch_page(user_id, "pending", BUTTON_FIELDS, direction, cursor)
+    if not tasks:
+        return False
+    selection["page"] = [[str(task["_id"]), shorten(task["title"], SELECTION_TITLE)] for task in tasks]
+    selection["prev"] = encode_cursor("s", "p", tasks[0], prefix="bs") if has_prev else None
+    selection["next"] = encode_cursor("s", "n", tasks[-1], prefix="bs") if has_next else None
+    return True
+
+
+def render_selection(selection: dict):
+    """Return (text, reply_markup) for the /select page held in `selection`.
+
+    Built from the selection alone, so ticking a task needs no database round trip.
+    """
+    selected = set(selection["selected"])
+    keyboard = [
+        [InlineKeyboardButton(f"{'☑️' if task_id in selected else '⬜'} {title}", callback_data=f"bs:t:{task_id}")]
+        for task_id, title in selection["page"]
+    ]
+    navigation = []
+    if selection["prev"]:
+        navigation.append(InlineKeyboardButton("◀ Prev", callback_data=selection["prev"]))
+    if selection["next"]:
+        navigation.append(InlineKeyboardButton("Next ▶", callback_data=selection["next"]))
+    if navigation:
+        keyboard.append(navigation)
+    keyboard += [
+        [InlineKeyboardButton(label, callback_data=f"bs:a:{action}") for label, action in row]
+        for row in SELECTION_ACTIONS
+    ]
+    text = f"Select tasks, then an action ({len(selected)} selected):"
+    return text, InlineKeyboardMarkup(keyboard)
@@ -0,0 +1,200 @@
+import asyncio
+import json
+import logging
+import os
+
+import bson
+from bson.errors import InvalidDocument
+from pymongo import UpdateOne
+from telegram import Update
+from telegram.ext import BasePersistence, ConversationHandler, PersistenceInput, TypeHandler
+
+from cache import TTLCache
+from db import conversations_collection
+
+logger = logging.getLogger(__name__)
+
+# How often PTB hands changed state over and dirty users are written back.
+FLUSH_INTERVAL = float(os.getenv("PERSISTENCE_FLUSH_SECONDS", "5"))
+# A user's state is reloaded from Mongo once it has been idle this long here,
+# so conversations continued on another worker are picked up.
+STATE_TTL = int(os.getenv("PERSISTENCE_STATE_TTL", "300"))
+# Whether a chat's document exists, as remembered in `_loaded`.
+STORED, EMPTY = "stored", "empty"
+
+
+def chat_key(chat_id: int) -> str:
+    """_id of a chat's document; users' documents are keyed by their int id."""
+    return f"chat:{chat_id}"
+
+
+class MongoPersistence(BasePersistence):
+    """Keep user_data and conversation states in `conversation_state`, one document per user.
+
+    chat_data goes into a document per chat, keyed by `chat_key`, which is
+    only written once the chat has stored something.
+
+    Nothing is loaded at startup: a user's document is read the first time one
+    of their updates is processed. Changes are staged per user in memory and
+    written with one unordered bulk_write every FLUSH_INTERVAL seconds, and on
+    shutdown.
+
+    PTB only reads conversation states from persistence at startup, so the
+    states loaded for a user are handed to the ConversationHandlers by
+    `restore_conversations`, which has to run in handler group -1.
+    """
+
+    def __init__(self, flush_interval: float = FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True, callback_data=False),
+            update_interval=flush_interval,
+        )
+        self.flush_interval = flush_interval
+        self._loaded = TTLCache("conversation_state", maxsize=100000, ttl=STATE_TTL)
+        self._restore = {}
+        self._pending = {}
+        self._flusher = None
+
+    # LOADING
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        """Load the user's document on their first update (or after STATE_TTL)."""
+        if self._loaded.get(user_id) or user_id in self._pending:
+            self._loaded.set(user_id, True)
+            return
+        doc = await conversations_collection.find_one({"_id": user_id}) or {}
+        user_data.clear()
+        user_data.update(doc.get("user_data", {}))
+        self._restore[user_id] = doc.get("conversations", {})
+        self._loaded.set(user_id, True)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data) -> None:
+        key = chat_key(chat_id)
+        state = self._loaded.get(key)
+        if state or key in self._pending:
+            self._loaded.set(key, state or STORED)
+            return
+        doc = await conversations_collection.find_one({"_id": key})
+        chat_data.clear()
+        chat_data.update((doc or {}).get("chat_data", {}))
+        self._loaded.set(key, STORED if doc else EMPTY)
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    async def restore_conversations(self, update: Update, context) -> None:
+        """Put the conversation states loaded for this update's user into the handlers."""
+        user = update.effective_user
+        stored = self._restore.pop(user.id, None) if user else None
+        if not stored:
+            return
+        for group in context.application.handlers.values():
+            for handler in group:
+                if isinstance(handler, ConversationHandler) and handler.persistent and handler.name in stored:
+                    states = {tuple(json.loads(key)): state for key, state in stored[handler.name].items()}
+                    # Same call PTB uses when it loads conversations at startup.
+                    handler._conversations.update_no_track(states)
+
+    def handler(self) -> TypeHandler:
+        """The group -1 handler that restores conversation states; see the class docstring."""
+        return TypeHandler(Update, self.restore_conversations)
+
+    # WRITE-BEHIND
+    def _stage(self, user_id: int, field: str, value=None, unset: bool = False) -> None:
+        changes = self._pending.setdefault(user_id, {"$set": {}, "$unset": {}})
+        changes["$unset" if unset else "$set"][field] = "" if unset else value
+        changes["$set" if unset else "$unset"].pop(field, None)
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_periodically())
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._stage(user_id, "user_data", data)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._stage(user_id, "user_data", unset=True)
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        # Conversations are per user, so the user id is the last part of the key.
+        field = f"conversations.{name}.{json.dumps(list(key))}"
+        if new_state is None:
+            self._stage(key[-1], field, unset=True)
+        else:
+            self._stage(key[-1], field, new_state)
+
+    async def update_chat_data(self, chat_id: int, data) -> None:
+        key = chat_key(chat_id)
+        # Most chats never use chat_data; they get no document.
+        if not data and self._loaded.get(key) == EMPTY:
+            return
+        self._loaded.set(key, STORED)
+        self._stage(key, "chat_data", data)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._stage(chat_key(chat_id), "chat_data", unset=True)
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def _write_pending(self) -> None:
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        for key, changes in list(pending.items()):
+            try:
+                bson.encode(changes)
+            except InvalidDocument:
+                # Retrying cannot help, and it would fail everyone else's writes in the batch.
+                logger.exception("Dropping unencodable conversation state of %s", key)
+                del pending[key]
+        if not pending:
+            return
+        writes = [
+            UpdateOne({"_id": user_id}, {op: fields for op, fields in changes.items() if fields}, upsert=True)
+            for user_id, changes in pending.items()
+        ]
+        try:
+            await conversations_collection.bulk_write(writes, ordered=False)
+        except BaseException:
+            # Failed or cancelled: put the batch back underneath anything staged since.
+            for user_id, changes in pending.items():
+                newer = self._pending.get(user_id)
+                if newer:
+                    for op in ("$set", "$unset"):
+                        for field in newer[op]:
+                            changes["$set"].pop(field, None)
+                            changes["$unset"].pop(field, None)
+                        changes[op].update(newer[op])
+                self._pending[user_id] = changes
+            raise
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self._write_pending()
+            except Exception:
+                # Whatever went wrong, later changes still have to be written.
+                logger.exception("Failed to write %d users' conversation state", len(self._pending))
+
+    async def flush(self) -> None:
+        if self._flusher:
+            self._flusher.cancel()
+            self._flusher = None
+        await self._write_pending()
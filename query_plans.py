@@ -0,0 +1,228 @@
+"""Explain every query the bot issues and fail on plans that do not use an index.
+
+Seeds a scratch database on a local mongod (MONGO_URI, default
+mongodb://localhost:27017), creates the indexes from `init_db`, and runs each
+query shape below through explain("executionStats"):
+
+    python query_plans.py
+
+Exits non-zero if a query falls back to a collection scan or examines more
+than MAX_EXAMINED_RATIO documents per document it returns.
+"""
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta
+
+os.environ["MONGO_DB"] = os.getenv("QUERY_PLANS_DB", "telegram_bot_query_plans")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+
+from bson.objectid import ObjectId
+
+from db import (
+    client,
+    conversations_collection,
+    db,
+    init_db,
+    leases_collection,
+    pomodoro_collection,
+    settings_collection,
+    stats_collection,
+    task_archive_collection,
+    tasks_collection,
+    timers_collection,
+    users_collection,
+    workers_collection,
+)
+from archive import ARCHIVE_BATCH, TIERS, archive_query
+from broadcast import BROADCAST_BATCH
+from cluster import POLLER_LEASE
+from pagination import PAGE_SIZE, page_query
+from scheduler import REMINDER_HORIZON, reminder_claim_filter, reminder_pipeline, reminder_window
+
+MAX_EXAMINED_RATIO = 4
+USERS = 200
+TASKS_PER_USER = 50
+
+
+async def seed():
+    await client.drop_database(db.name)
+    now = datetime.utcnow()
+    await users_collection.insert_many(
+        [{"user_id": user_id, "username": f"user{user_id}"} for user_id in range(USERS)]
+    )
+    await settings_collection.insert_many(
+        [{"user_id": user_id, "notifications": user_id % 3 != 0} for user_id in range(USERS)]
+    )
+    await stats_collection.insert_many([{"user_id": user_id, "completed_tasks": 0} for user_id in range(USERS)])
+    await tasks_collection.insert_many([
+        {
+            "user_id": user_id,
+            "title": f"Task {n}",
+            "description": "",
+            "due_date": (now + timedelta(hours=n * 7 - 100)).replace(minute=0, second=0, microsecond=0),
+            "status": "completed" if n % 2 else "pending",
+            "created_at": now,
+            **({"completed_at": now - timedelta(days=n)} if n % 2 else {}),
+        }
+        for user_id in range(USERS)
+        for n in range(TASKS_PER_USER)
+    ])
+    await pomodoro_collection.insert_many([
+        {"user_id": user_id, "start_time": now - timedelta(days=n), "sessions_completed": 1}
+        for user_id in range(USERS)
+        for n in range(10)
+    ])
+    await timers_collection.insert_many(
+        [{"_id": user_id, "user_id": user_id, "phase": "work"} for user_id in range(0, USERS, 10)]
+    )
+    await init_db()
+
+
+async def query_shapes():
+    """(name, explain command, allow collection scan) for every query in the bot."""
+    user_id = 7
+    task = await tasks_collection.find_one({"user_id": user_id, "status": "pending"})
+    cursor = (task["due_date"], task["_id"])
+    now = datetime.utcnow()
+
+    def find(collection, query, sort=None, limit=0, projection=None):
+        command = {"find": collection.name, "filter": query}
+        if sort:
+            command["sort"] = dict(sort)
+        if limit:
+            command["limit"] = limit
+        if projection:
+            command["projection"] = projection
+        return command
+
+    def aggregate(collection, pipeline):
+        return {"aggregate": collection.name, "pipeline": pipeline, "cursor": {}}
+
+    def update(collection, query, change, multi=False):
+        return {"update": collection.name, "updates": [{"q": query, "u": change, "multi": multi}]}
+
+    shapes = []
+    for status in ("pending", "completed"):
+        for direction, page_cursor in (("n", None), ("n", cursor), ("p", cursor)):
+            query, sort = page_query(user_id, status, direction, page_cursor)
+            shapes.append((
+                f"task page ({status}, {direction}, {'cursor' if page_cursor else 'first'})",
+                find(tasks_collection, query, sort, PAGE_SIZE + 1),
+                False,
+            ))
+    shapes += [
+        ("task by id", find(tasks_collection, {"_id": task["_id"], "user_id": user_id}), False),
+        ("selected tasks", find(
+            tasks_collection, {"_id": {"$in": [task["_id"], ObjectId()]}, "user_id": user_id, "status": "pending"}
+        ), False),
+        ("next occurrence upsert", find(tasks_collection, {"series_id": task["_id"], "occurrence": 2}), False),
+        ("task search", find(
+            tasks_collection,
+            {"user_id": user_id, "$text": {"$search": "Task 3"}},
+            [("score", {"$meta": "textScore"}), ("_id", 1)],
+            PAGE_SIZE + 1,
+            {"title": 1, "score": {"$meta": "textScore"}},
+        ), False),
+        ("reminder window", aggregate(
+            tasks_collection, reminder_pipeline(reminder_window(now, now + REMINDER_HORIZON))
+        ), False),
+        ("reminder claim", update(
+            tasks_collection,
+            reminder_claim_filter([task["_id"]]),
+            [{"$set": {"reminded_for": "$due_date", "reminder_claim": ObjectId()}}],
+            multi=True,
+        ), False),
+        ("settings by user", find(settings_collection, {"user_id": user_id}), False),
+        ("stats by user", find(stats_collection, {"user_id": user_id}), False),
+        ("profile by user", find(users_collection, {"user_id": user_id}), False),
+        ("sessions by user", find(
+            pomodoro_collection, {"user_id": user_id}, [("start_time", -1)]
+        ), False),
+        ("timer by user", find(timers_collection, {"_id": user_id}), False),
+        ("report sessions", find(
+            pomodoro_collection, {"user_id": user_id, "start_time": {"$gte": now - timedelta(days=7)}}
+        ), False),
+        ("report completions", find(
+            tasks_collection, {"user_id": user_id, "status": "completed", "completed_at": {"$gte": now - timedelta(days=30)}}
+        ), False),
+        ("report tasks due", find(tasks_collection, {
+            "user_id": user_id,
+            "status": {"$in": ["pending", "completed"]},
+            "due_date": {"$gte": now - timedelta(days=7), "$lt": now},
+        }), False),
+        ("archivable tasks", find(
+            tasks_collection,
+            archive_query(TIERS["tasks"], now - timedelta(days=40)),
+            [("completed_at", 1), ("_id", 1)],
+            ARCHIVE_BATCH,
+        ), False),
+        ("archivable sessions", find(
+            pomodoro_collection, {"start_time": {"$lt": now - timedelta(days=8)}}, [("start_time", 1), ("_id", 1)], ARCHIVE_BATCH
+        ), False),
+        ("archived tasks by user", find(
+            task_archive_collection, {"user_id": user_id}, [("end", -1), ("_id", -1)], projection={"count": 1}
+        ), False),
+        ("conversation state by user", find(conversations_collection, {"_id": user_id}), False),
+        # Sessions are all reloaded at startup by design.
+        ("timer recovery", find(timers_collection, {}), True),
+        ("broadcast batch", find(
+            users_collection,
+            {"_id": {"$gt": ObjectId()}, "blocked": {"$ne": True}},
+            [("_id", 1)],
+            BROADCAST_BATCH,
+            {"user_id": 1},
+        ), False),
+        ("live workers", find(workers_collection, {"expires_at": {"$gt": now}}), False),
+        ("free leases", find(leases_collection, {
+            "_id": {"$ne": POLLER_LEASE},
+            "$or": [{"owner": None}, {"expires_at": {"$lte": now}}],
+        }), False),
+    ]
+    return shapes
+
+
+def walk(node):
+    if isinstance(node, dict):
+        yield node
+        for value in node.values():
+            yield from walk(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from walk(value)
+
+
+def check(name: str, explain: dict, allow_collscan: bool) -> list:
+    problems = []
+    stages = [node["stage"] for node in walk(explain) if isinstance(node.get("stage"), str)]
+    lookup_scans = sum(node.get("collectionScans", 0) for node in walk(explain))
+    if not allow_collscan and ("COLLSCAN" in stages or lookup_scans):
+        problems.append(f"{name}: collection scan")
+
+    stats = [node for node in walk(explain) if "totalDocsExamined" in node and "nReturned" in node]
+    examined = sum(node["totalDocsExamined"] for node in stats)
+    returned = max(sum(node["nReturned"] for node in stats), 1)
+    if not allow_collscan and examined > returned * MAX_EXAMINED_RATIO:
+        problems.append(f"{name}: examined {examined} documents to return {returned}")
+    print(f"{'FAIL' if problems else 'ok  '} {name:40} examined={examined} returned={returned}")
+    return problems
+
+
+async def main() -> int:
+    await seed()
+    problems = []
+    try:
+        for name, command, allow_collscan in await query_shapes():
+            explain = await db.command({"explain": command, "verbosity": "executionStats"})
+            problems += check(name, explain, allow_collscan)
+    finally:
+        await client.drop_database(db.name)
+        await client.close()
+
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,165 @@
+"""Recurring tasks.
+
+A recurring task is an ordinary task with a `recurrence` rule, stored as an
+RRULE subset string such as "FREQ=WEEKLY;INTERVAL=1;BYDAY=MO,TH". Only the
+next occurrence exists as a document: completing it inserts the one after,
+so a series costs one pending task however long it runs, and its reminder
+comes from the usual pending due_date index.
+"""
+import calendar
+from datetime import datetime, timedelta
+
+WEEKDAYS = ("MO", "TU", "WE", "TH", "FR", "SA", "SU")
+FREQUENCIES = ("DAILY", "WEEKLY", "MONTHLY")
+UNITS = {"day": "DAILY", "week": "WEEKLY", "month": "MONTHLY"}
+
+RECURRENCE_HELP = (
+    "daily, weekly, monthly, weekdays, every 3 days, every 2 weeks, "
+    "or an RRULE like FREQ=WEEKLY;BYDAY=MO,TH;COUNT=10"
+)
+
+
+def parse_rrule(text: str) -> dict:
+    """Parse the supported RRULE subset: FREQ, INTERVAL, BYDAY, COUNT and UNTIL."""
+    rule = {"interval": 1}
+    for part in text.upper().removeprefix("RRULE:").split(";"):
+        if not part.strip():
+            continue
+        key, _, value = part.strip().partition("=")
+        if key == "FREQ" and value in FREQUENCIES:
+            rule["freq"] = value
+        elif key == "INTERVAL" and value.isdigit() and int(value) > 0:
+            rule["interval"] = int(value)
+        elif key == "BYDAY" and value and all(day in WEEKDAYS for day in value.split(",")):
+            rule["byday"] = sorted({WEEKDAYS.index(day) for day in value.split(",")})
+        elif key == "COUNT" and value.isdigit() and int(value) > 0:
+            rule["count"] = int(value)
+        elif key == "UNTIL":
+            try:
+                rule["until"] = datetime.strptime(value[:8], "%Y%m%d")
+            except ValueError:
+                raise ValueError(f"bad UNTIL date {value!r}") from None
+        else:
+            raise ValueError(f"unsupported rule part {part.strip()!r}")
+    if "freq" not in rule:
+        raise ValueError("FREQ must be DAILY, WEEKLY or MONTHLY")
+    if "byday" in rule and rule["freq"] != "WEEKLY":
+        raise ValueError("BYDAY is only supported with FREQ=WEEKLY")
+    return rule
+
+
+def parse_recurrence(text: str) -> dict:
+    """Parse what a user typed; see RECURRENCE_HELP for the accepted forms."""
+    words = text.strip().lower().split()
+    if not words:
+        raise ValueError("empty rule")
+    if "=" in text:
+        return parse_rrule(text)
+    if words in (["daily"], ["every", "day"]):
+        return {"freq": "DAILY", "interval": 1}
+    if words in (["weekly"], ["every", "week"]):
+        return {"freq": "WEEKLY", "interval": 1}
+    if words in (["monthly"], ["every", "month"]):
+        return {"freq": "MONTHLY", "interval": 1}
+    if words == ["weekdays"]:
+        return {"freq": "WEEKLY", "interval": 1, "byday": [0, 1, 2, 3, 4]}
+    if len(words) == 3 and words[0] == "every" and words[1].isdigit() and int(words[1]) > 0:
+        unit = UNITS.get(words[2].rstrip("s"))
+        if unit:
+            return {"freq": unit, "interval": int(words[1])}
+    raise ValueError(f"could not understand {text.strip()!r}")
+
+
+def format_rule(rule: dict) -> str:
+    parts = [f"FREQ={rule['freq']}", f"INTERVAL={rule['interval']}"]
+    if rule.get("byday"):
+        parts.append("BYDAY=" + ",".join(WEEKDAYS[day] for day in rule["byday"]))
+    if rule.get("count"):
+        parts.append(f"COUNT={rule['count']}")
+    if rule.get("until"):
+        parts.append(f"UNTIL={rule['until']:%Y%m%d}")
+    return ";".join(parts)
+
+
+def describe(rrule: str) -> str:
+    rule = parse_rrule(rrule)
+    unit = {"DAILY": "day", "WEEKLY": "week", "MONTHLY": "month"}[rule["freq"]]
+    text = f"every {unit}" if rule["interval"] == 1 else f"every {rule['interval']} {unit}s"
+    if rule.get("byday"):
+        text += " on " + ", ".join(calendar.day_abbr[day] for day in rule["byday"])
+    if rule.get("count"):
+        text += f", {rule['count']} times"
+    if rule.get("until"):
+        text += f", until {rule['until']:%Y-%m-%d}"
+    return text
+
+
+def _add_months(start: datetime, months: int):
+    month = start.month - 1 + months
+    year, month = start.year + month // 12, month % 12 + 1
+    if start.day > calendar.monthrange(year, month)[1]:
+        return None  # Like RRULE, months without that day are skipped.
+    return start.replace(year=year, month=month)
+
+
+def _following(rule: dict, start: datetime, after: datetime) -> datetime:
+    """The first occurrence of the series starting at `start` that is later than `after`."""
+    interval = rule["interval"]
+    if rule["freq"] == "DAILY":
+        steps = (after - start).days // interval + 1
+        return start + timedelta(days=steps * interval)
+
+    if rule["freq"] == "MONTHLY":
+        months = (after.year - start.year) * 12 + after.month - start.month
+        months -= months % interval
+        while True:
+            candidate = _add_months(start, months)
+            if candidate and candidate > after:
+                return candidate
+            months += interval
+
+    week_start = start - timedelta(days=start.weekday())
+    byday = rule.get("byday") or [start.weekday()]
+    day = after + timedelta(days=1)
+    while True:
+        candidate = day.replace(hour=start.hour, minute=start.minute, second=start.second, microsecond=0)
+        weeks = (candidate - week_start).days // 7
+        if candidate > after and candidate.weekday() in byday and weeks % interval == 0:
+            return candidate
+        day += timedelta(days=1)
+
+
+def next_occurrence(task: dict, now: datetime):
+    """Return the task document of the occurrence after `task`, or None if the series is over.
+
+    Occurrences that already passed while the task was open are skipped, so
+    the next one is due today at the earliest.
+    """
+    rule = parse_rrule(task["recurrence"])
+    start = task.get("series_start", task["due_date"])
+    occurrence = task.get("occurrence", 1)
+    today = datetime(now.year, now.month, now.day)
+
+    due_date = task["due_date"]
+    while True:
+        due_date = _following(rule, start, due_date)
+        occurrence += 1
+        if rule.get("count") and occurrence > rule["count"]:
+            return None
+        if rule.get("until") and due_date >= rule["until"] + timedelta(days=1):
+            return None
+        if due_date >= today:
+            break
+
+    return {
+        "user_id": task["user_id"],
+        "title": task["title"],
+        "description": task.get("description", ""),
+        "due_date": due_date,
+        "status": "pending",
+        "created_at": now,
+        "recurrence": task["recurrence"],
+        "series_id": task.get("series_id", task["_id"]),
+        "series_start": start,
+        "occurrence": occurrence,
+    }
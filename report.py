@@ -0,0 +1,190 @@
+"""/report: focus and task analytics over the last week, month or year.
+
+History is pulled as columns (one array per field) from both the hot and the
+archive tier and aggregated with NumPy; the chart is drawn by charts.py in a
+process pool so plotting never blocks the event loop. numpy and matplotlib
+are optional dependencies, imported on the first report.
+"""
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+from archive import iter_archived
+from cache import VersionedCache
+from charts import render_report_chart
+from db import pomodoro_collection, tasks_collection
+
+PERIODS = {"week": 7, "month": 30, "year": 365}
+# Days per bar of the chart.
+CHART_BINS = {"week": 1, "month": 1, "year": 7}
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", "2"))
+# Bound on how stale a report can be when its data is changed by another worker.
+REPORT_CACHE_TTL = int(os.getenv("REPORT_CACHE_TTL", "600"))
+
+SESSION_FIELDS = {"start_time": 1, "focus_minutes": 1, "sessions_completed": 1, "work_duration": 1}
+
+# Reports by (period, day) per user; handlers bump a user's version when
+# they change the history reports are built from.
+report_cache = VersionedCache("reports", maxsize=1000, ttl=REPORT_CACHE_TTL, max_values=2 * len(PERIODS))
+MISSING = object()
+
+_pool = None
+
+
+def chart_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # Spawned, not forked: the bot's threads and sockets stay behind.
+        _pool = ProcessPoolExecutor(REPORT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def shutdown_chart_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def focus_minutes(session: dict) -> int:
+    if "focus_minutes" in session:
+        return session["focus_minutes"]
+    return (session.get("sessions_completed") or 0) * (session.get("work_duration") or 0)
+
+
+async def load_history(user_id: int, since: datetime, now: datetime) -> dict:
+    """A user's sessions and tasks since `since`, as lists per field."""
+    sessions, completed, due = await asyncio.gather(
+        pomodoro_collection.find({"user_id": user_id, "start_time": {"$gte": since}}, SESSION_FIELDS).to_list(None),
+        tasks_collection.find(
+            {"user_id": user_id, "status": "completed", "completed_at": {"$gte": since}}, {"completed_at": 1}
+        ).to_list(None),
+        tasks_collection.find(
+            {"user_id": user_id, "status": {"$in": ["pending", "completed"]}, "due_date": {"$gte": since, "$lt": now}},
+            {"status": 1},
+        ).to_list(None),
+    )
+    sessions += [session async for session in iter_archived("sessions", user_id, since)]
+    due_done = [task["status"] == "completed" for task in due]
+    async for task in iter_archived("tasks", user_id, since):
+        completed.append(task)
+        if since <= task["due_date"] < now:
+            due_done.append(True)
+
+    return {
+        "start": [session["start_time"] for session in sessions],
+        "focus": [focus_minutes(session) for session in sessions],
+        "sessions": [session.get("sessions_completed") or 0 for session in sessions],
+        "completed_at": [task["completed_at"] for task in completed if task.get("completed_at")],
+        "due_done": due_done,
+    }
+
+
+def analyze(np, history: dict, days: int, today: datetime) -> dict:
+    """Per-day focus and completions, streaks and best hours for the `days` ending `today`."""
+    first = np.datetime64(today.date()) - np.timedelta64(days - 1, "D")
+    start = np.array(history["start"], dtype="datetime64[m]")
+    focus = np.array(history["focus"], dtype=float)
+    sessions = np.array(history["sessions"], dtype=int)
+    completed_at = np.array(history["completed_at"], dtype="datetime64[m]")
+    due_done = np.array(history["due_done"], dtype=bool)
+
+    # Archive buckets can reach back before the period.
+    session_day = (start.astype("datetime64[D]") - first).astype(int)
+    in_period = (session_day >= 0) & (session_day < days)
+    start, focus, sessions, session_day = start[in_period], focus[in_period], sessions[in_period], session_day[in_period]
+    done_day = (completed_at.astype("datetime64[D]") - first).astype(int)
+    done_day = done_day[(done_day >= 0) & (done_day < days)]
+
+    focus_per_day = np.bincount(session_day, weights=focus, minlength=days)
+    done_per_day = np.bincount(done_day, minlength=days)
+
+    # Streaks are runs of days with any focus or any completed task.
+    active = (focus_per_day > 0) | (done_per_day > 0)
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], active.astype(np.int8), [0]))))
+    runs = edges[1::2] - edges[::2]
+    # The current streak survives a quiet today until the day is over.
+    current = int(runs[-1]) if runs.size and edges[-1] >= days - 1 else 0
+
+    hours = (start - start.astype("datetime64[D]")).astype("timedelta64[h]").astype(int)
+    focus_per_hour = np.bincount(hours, weights=focus, minlength=24)
+    best_hours = [int(hour) for hour in np.argsort(-focus_per_hour, kind="stable")[:3] if focus_per_hour[hour] > 0]
+
+    return {
+        "first": first,
+        "focus_per_day": focus_per_day,
+        "done_per_day": done_per_day,
+        "total_focus": int(focus_per_day.sum()),
+        "sessions": int(sessions.sum()),
+        "completed": int(done_per_day.sum()),
+        "due": int(due_done.size),
+        "completion_rate": float(due_done.mean()) if due_done.size else None,
+        "active_days": int(active.sum()),
+        "current_streak": current,
+        "longest_streak": int(runs.max()) if runs.size else 0,
+        "best_hours": best_hours,
+    }
+
+
+def chart_columns(np, stats: dict, days: int, bin_days: int):
+    """(labels, focus, completed) with `bin_days` days per bar, oldest first."""
+    bins = -(-days // bin_days)
+    pad = bins * bin_days - days
+    focus = np.concatenate((np.zeros(pad), stats["focus_per_day"])).reshape(bins, bin_days).sum(axis=1)
+    done = np.concatenate((np.zeros(pad), stats["done_per_day"])).reshape(bins, bin_days).sum(axis=1)
+    starts = stats["first"] - np.timedelta64(pad, "D") + np.arange(bins) * np.timedelta64(bin_days, "D")
+    labels = [str(day)[5:] for day in starts.astype("datetime64[D]")]
+    return labels, focus.tolist(), done.astype(int).tolist()
+
+
+def caption(period: str, stats: dict) -> str:
+    hours, minutes = divmod(stats["total_focus"], 60)
+    lines = [
+        f"📈 Your report for the last {period} (UTC)",
+        f"⏱️ Focus: {hours} h {minutes} min over {stats['sessions']} sessions",
+        f"✅ Tasks completed: {stats['completed']}",
+    ]
+    if stats["completion_rate"] is not None:
+        lines.append(f"🎯 Completion rate: {stats['completion_rate']:.0%} of {stats['due']} tasks due")
+    lines.append(
+        f"🔥 Streak: {stats['current_streak']} days (longest {stats['longest_streak']}, "
+        f"{stats['active_days']} active days)"
+    )
+    if stats["best_hours"]:
+        lines.append("🕐 Best hours: " + ", ".join(f"{hour:02d}:00" for hour in stats["best_hours"]))
+    return "\n".join(lines)
+
+
+async def build_report(user_id: int, period: str):
+    """Return {"caption", "photo"} for the user's report, or None if the period is empty.
+
+    Reports are cached per (user, period, day, version of the user's data).
+    "photo" holds the PNG until the caller replaces it with the file_id
+    Telegram assigned, which later sends of the same report reuse.
+    Raises ImportError if numpy or matplotlib is missing.
+    """
+    import numpy as np
+
+    now = datetime.utcnow()
+    key = (period, now.date())
+    entry = report_cache.entry(user_id)
+    version = entry["version"]
+    report = entry["values"].get(key, MISSING)
+    if report is not MISSING:
+        return report
+
+    days = PERIODS[period]
+    since = datetime(now.year, now.month, now.day) - timedelta(days=days - 1)
+    history = await load_history(user_id, since, now)
+    stats = analyze(np, history, days, now)
+    report = None
+    if stats["total_focus"] or stats["completed"] or stats["due"]:
+        labels, focus, done = chart_columns(np, stats, days, CHART_BINS[period])
+        photo = await asyncio.get_running_loop().run_in_executor(
+            chart_pool(), render_report_chart, labels, focus, done, f"Last {period}"
+        )
+        report = {"caption": caption(period, stats), "photo": photo}
+    report_cache.store(entry, version, key, report)
+    return report
@@ -0,0 +1,369 @@
+import abc
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+
+from cluster import partition_filter, partition_of
+from db import COLLECTIONS, tasks_collection
+from metrics import Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+# How long before a task's due date its reminder fires.
+REMINDER_OFFSET = timedelta(minutes=int(os.getenv("REMINDER_OFFSET_MINUTES", "1440")))
+# How far ahead of now reminders are kept in memory; later ones are loaded
+# one window at a time as the horizon advances.
+REMINDER_HORIZON = timedelta(hours=6)
+# Longest wait between retries of a window that failed to load.
+REFILL_RETRY_MAX = 60
+SCHEDULED_KEYS = Gauge("scheduler_keys", "Keys waiting for their deadline.", ["scheduler"])
+SCHEDULER_LAG = Histogram(
+    "scheduler_lag_seconds", "How late the oldest key of each batch fired.", ["scheduler"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 15, 60, 300, 3600),
+)
+FIRE_SECONDS = Histogram("scheduler_fire_seconds", "Time spent firing one batch of keys.", ["scheduler"])
+
+# Reminder candidates are streamed from Mongo and sent this many at a time.
+REMINDER_BATCH_SIZE = 500
+
+
+def reminder_pipeline(match: dict) -> list:
+    """Join tasks matching `match` with their owner's settings and profile.
+
+    Users with notifications off, who blocked the bot (or with no
+    settings/profile at all) are dropped by the server, so they are never
+    shipped to the bot.
+    """
+    return [
+        {"$match": match},
+        {"$lookup": {
+            "from": COLLECTIONS["user_settings"],
+            "localField": "user_id",
+            "foreignField": "user_id",
+            "pipeline": [{"$match": {"notifications": True}}, {"$project": {"_id": 1}}],
+            "as": "settings",
+        }},
+        {"$match": {"settings": {"$ne": []}}},
+        {"$lookup": {
+            "from": COLLECTIONS["users"],
+            "localField": "user_id",
+            "foreignField": "user_id",
+            "pipeline": [{"$match": {"blocked": {"$ne": True}}}, {"$project": {"_id": 1}}],
+            "as": "user",
+        }},
+        {"$match": {"user": {"$ne": []}}},
+        {"$project": {"user_id": 1, "title": 1, "due_date": 1, "reminded_for": 1}},
+    ]
+
+
+def reminder_window(start: datetime, end: datetime) -> dict:
+    """Pending tasks whose reminder fires in (start, end].
+
+    Served by the partial index on pending tasks' due_date.
+    """
+    return {
+        "due_date": {
+            "$gt": max(start + REMINDER_OFFSET, datetime.utcnow()),
+            "$lte": end + REMINDER_OFFSET,
+        },
+        "status": "pending",
+    }
+
+
+def reminder_claim_filter(task_ids: list) -> dict:
+    return {
+        "_id": {"$in": task_ids},
+        "status": "pending",
+        "$expr": {"$ne": ["$reminded_for", "$due_date"]},
+    }
+
+
+async def iter_batches(cursor, size: int = REMINDER_BATCH_SIZE):
+    batch = []
+    async for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class DeadlineScheduler(abc.ABC):
+    """Fire keys at their deadline from a single heap on the event loop.
+
+    Subclasses implement `fire`, which gets every key that came due together.
+
+    Rescheduling a key just pushes a new heap entry; stale entries are
+    skipped when they reach the top, so every change costs O(log n).
+    Deadlines are given as UTC datetimes but kept on the time.monotonic()
+    clock, so stepping the system clock does not move keys already waiting.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._heap = []
+        self._deadlines = {}
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._runner = None
+        # Partitions of users this worker handles; None means all of them.
+        self.partitions = None
+        SCHEDULED_KEYS.track(self.__len__, scheduler=name)
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def owns(self, user_id: int) -> bool:
+        return self.partitions is None or partition_of(user_id) in self.partitions
+
+    @staticmethod
+    def _monotonic(deadline: datetime) -> float:
+        return time.monotonic() + (deadline - datetime.utcnow()).total_seconds()
+
+    def schedule(self, key, deadline: datetime) -> None:
+        deadline = self._monotonic(deadline)
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, next(self._counter), key))
+        if self._heap[0][2] == key:
+            self._wakeup.set()
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._compact()
+
+    def cancel(self, key) -> None:
+        self._deadlines.pop(key, None)
+
+    def _compact(self):
+        self._heap = [
+            entry for entry in self._heap if self._deadlines.get(entry[2]) == entry[0]
+        ]
+        heapq.heapify(self._heap)
+
+    def _pop_due(self, now: float) -> list:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, key = heapq.heappop(self._heap)
+            if self._deadlines.get(key) == deadline:
+                del self._deadlines[key]
+                due.append(key)
+        return due
+
+    def _next_deadline(self):
+        while self._heap and self._deadlines.get(self._heap[0][2]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    @abc.abstractmethod
+    async def fire(self, keys: list) -> None:
+        """Handle keys whose deadline has passed."""
+
+    async def run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            deadline = self._next_deadline()
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.monotonic()
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            now = time.monotonic()
+            due = self._pop_due(now)
+            if not due:
+                continue
+            SCHEDULER_LAG.observe(now - deadline, scheduler=self.name)
+            started = time.perf_counter()
+            try:
+                await self.fire(due)
+            except Exception:
+                logger.exception("%s scheduler failed to fire %d keys", self.name, len(due))
+            FIRE_SECONDS.observe(time.perf_counter() - started, scheduler=self.name)
+
+    def start(self) -> None:
+        self._runner = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._runner:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+
+
+class ReminderScheduler(DeadlineScheduler):
+    """Send each pending task's reminder once, REMINDER_OFFSET before it is due.
+
+    Only reminders inside REMINDER_HORIZON are held in the heap. A refill entry
+    loads the next window with one range query, and handlers keep the heap in
+    sync by calling schedule_task / cancel_task when they change a task.
+    """
+
+    REFILL = "__refill__"
+
+    def __init__(self):
+        super().__init__("reminder")
+        self._notify = None
+        self._tasks = {}
+        self._loaded_until = None
+        self._refill_failures = 0
+
+    @staticmethod
+    def reminder_time(due_date: datetime) -> datetime:
+        return due_date - REMINDER_OFFSET
+
+    def schedule_task(self, task: dict) -> None:
+        """Add, move or drop a task's reminder after it was written."""
+        task_id = task["_id"]
+        if (
+            task.get("status") != "pending"
+            or task["due_date"] < datetime.utcnow()
+            or task.get("reminded_for") == task["due_date"]
+            or not self.owns(task["user_id"])
+        ):
+            self.cancel_task(task_id)
+            return
+        fire_at = self.reminder_time(task["due_date"])
+        if self._loaded_until is None or fire_at > self._loaded_until:
+            # Outside the loaded window; the refill for that window picks it up.
+            self.cancel_task(task_id)
+            return
+        self._tasks[task_id] = (task["user_id"], task["due_date"])
+        self.schedule(task_id, fire_at)
+
+    def cancel_task(self, task_id) -> None:
+        self._tasks.pop(task_id, None)
+        self.cancel(task_id)
+
+    async def on_change(self, change: dict) -> None:
+        """Apply a change made to `tasks` by another worker."""
+        if change["operationType"] == "delete":
+            self.cancel_task(change["documentKey"]["_id"])
+        elif change.get("fullDocument"):
+            self.schedule_task(change["fullDocument"])
+
+    async def add_partitions(self, partitions: set) -> None:
+        self.partitions = (self.partitions or set()) | partitions
+        if self._loaded_until is not None:
+            await self.load_window(
+                datetime.utcnow() - REMINDER_OFFSET, self._loaded_until, partition_filter(partitions)
+            )
+
+    def drop_partitions(self, partitions: set) -> None:
+        self.partitions = (self.partitions or set()) - partitions
+        for task_id, (user_id, _) in list(self._tasks.items()):
+            if partition_of(user_id) in partitions:
+                self.cancel_task(task_id)
+
+    async def load_window(self, start: datetime, end: datetime, match: dict = None) -> None:
+        """Queue reminders that fire in (start, end].
+
+        Without `match` this advances the horizon to `end`, and puts it back
+        if the query fails so the window is loaded again.
+        """
+        window = reminder_window(start, end)
+        previous = self._loaded_until
+        if match:
+            window.update(match)
+        else:
+            # Advance the horizon before querying, so partitions acquired and
+            # tasks written while the query runs are queued for this window.
+            self._loaded_until = end
+            self.schedule(self.REFILL, end)
+            if self.partitions is not None:
+                window.update(partition_filter(self.partitions))
+        try:
+            if self.partitions is None or self.partitions:
+                await self._queue(window)
+        except BaseException:
+            if not match:
+                self._loaded_until = previous
+                self.cancel(self.REFILL)
+            raise
+
+    async def _queue(self, window: dict) -> None:
+        cursor = await tasks_collection.aggregate(
+            reminder_pipeline(window), batchSize=REMINDER_BATCH_SIZE
+        )
+        async for batch in iter_batches(cursor):
+            for task in batch:
+                if task.get("reminded_for") == task["due_date"] or not self.owns(task["user_id"]):
+                    continue
+                self._tasks[task["_id"]] = (task["user_id"], task["due_date"])
+                self.schedule(task["_id"], self.reminder_time(task["due_date"]))
+
+    async def schedule_user(self, user_id: int) -> None:
+        """Queue a user's reminders in the loaded window, e.g. after they enable notifications."""
+        if self._loaded_until is not None and self.owns(user_id):
+            await self.load_window(
+                datetime.utcnow() - REMINDER_OFFSET, self._loaded_until, {"user_id": user_id}
+            )
+
+    async def refill(self) -> None:
+        """Load the next window, retrying with backoff until it succeeds."""
+        if self._loaded_until is None:
+            # First load: reminders missed while the bot was down fire straight away.
+            now = datetime.utcnow()
+            start, end = now - REMINDER_OFFSET, now + REMINDER_HORIZON
+        else:
+            start, end = self._loaded_until, self._loaded_until + REMINDER_HORIZON
+        try:
+            await self.load_window(start, end)
+        except Exception:
+            delay = min(REFILL_RETRY_MAX, 2 ** self._refill_failures)
+            self._refill_failures += 1
+            logger.exception("Failed to load reminders, retrying in %d s", delay)
+            self.schedule(self.REFILL, datetime.utcnow() + timedelta(seconds=delay))
+            return
+        self._refill_failures = 0
+
+    async def fire(self, keys: list) -> None:
+        if self.REFILL in keys:
+            keys.remove(self.REFILL)
+            await self.refill()
+
+        task_ids = [key for key in keys if self._tasks.pop(key, None) is not None]
+        if not task_ids:
+            return
+
+        # Claiming the reminders in the task documents keeps them exactly-once
+        # across restarts and repeated loads of the same window. One
+        # update_many claims the whole batch and tags it so the join below
+        # only returns what this call claimed.
+        claim = ObjectId()
+        await tasks_collection.update_many(
+            reminder_claim_filter(task_ids),
+            [{"$set": {"reminded_for": "$due_date", "reminder_claim": claim}}],
+        )
+        cursor = await tasks_collection.aggregate(
+            reminder_pipeline({"_id": {"$in": task_ids}, "reminder_claim": claim}),
+            batchSize=REMINDER_BATCH_SIZE,
+        )
+        async for batch in iter_batches(cursor):
+            await asyncio.gather(*(
+                self._notify(task["user_id"], task["title"], task["due_date"]) for task in batch
+            ))
+
+    def start(self, notify) -> None:
+        """Start firing reminders; `notify(user_id, title, due_date)` sends one."""
+        self._notify = notify
+        super().start()
+
+    async def run(self) -> None:
+        # The first window is loaded like any other, retries included.
+        self.schedule(self.REFILL, datetime.utcnow())
+        await super().run()
@@ -0,0 +1,61 @@
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from db import tasks_collection
+from pagination import PAGE_SIZE, shorten
+
+# Only the best matches are paged through; refine the query to see others.
+MAX_RESULTS = 100
+MAX_QUERY = 100
+MAX_BUTTON_TITLE = 40
+
+
+async def search_tasks(user_id: int, text: str, page: int = 0):
+    """Return (tasks, has_next) for one page of a user's tasks matching `text`, best first.
+
+    Served by the (user_id, title text, description text) index.
+    """
+    if page * PAGE_SIZE >= MAX_RESULTS:
+        return [], False
+    cursor = (
+        tasks_collection.find(
+            {"user_id": user_id, "$text": {"$search": text}},
+            {"title": 1, "status": 1, "due_date": 1, "score": {"$meta": "textScore"}},
+        )
+        .sort([("score", {"$meta": "textScore"}), ("_id", 1)])
+        .skip(page * PAGE_SIZE)
+        .limit(min(PAGE_SIZE + 1, MAX_RESULTS - page * PAGE_SIZE))
+    )
+    tasks = await cursor.to_list(None)
+    return tasks[:PAGE_SIZE], len(tasks) > PAGE_SIZE
+
+
+async def render_search(user_id: int, text: str, page: int = 0):
+    """Return (text, reply_markup) for a page of search results, or None if nothing matches.
+
+    Pending tasks get a done_ button next to their edit_ button, so results
+    lead straight into the usual mark-done and edit flows.
+    """
+    tasks, has_next = await search_tasks(user_id, text, page)
+    if not tasks:
+        return None
+
+    lines = [f"🔍 Results for “{text}”:"]
+    keyboard = []
+    for rank, task in enumerate(tasks, start=page * PAGE_SIZE + 1):
+        icon = "📌" if task["status"] == "pending" else "✅"
+        lines.append(f"{rank}. {icon} {shorten(task['title'])} (due {task['due_date']:%Y-%m-%d})")
+        row = [InlineKeyboardButton(
+            f"✏ {rank}. {shorten(task['title'], MAX_BUTTON_TITLE)}", callback_data=f"edit_{task['_id']}"
+        )]
+        if task["status"] == "pending":
+            row.append(InlineKeyboardButton("✅ Done", callback_data=f"done_{task['_id']}"))
+        keyboard.append(row)
+
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("◀ Prev", callback_data=f"sr:{page - 1}"))
+    if has_next:
+        navigation.append(InlineKeyboardButton("Next ▶", callback_data=f"sr:{page + 1}"))
+    if navigation:
+        keyboard.append(navigation)
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
@@ -0,0 +1,283 @@
+"""Per-user productivity statistics.
+
+Totals live in one `statistics` document per user, which also carries the
+session count of the current day, so /stats is a single find_one. Every
+increment is mirrored into a per-day bucket in `daily_stats`. Increments are
+buffered by `stats_buffer` and written in batches; /stats adds the buffered
+part back in, so it is never behind. Run
+`python stats.py backfill` to rebuild both from `pomodoro_sessions` and
+`tasks` history.
+"""
+import asyncio
+import logging
+import os
+import sys
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from db import COLLECTIONS, daily_stats_collection, pomodoro_collection, stats_collection, tasks_collection
+
+logger = logging.getLogger(__name__)
+
+# Counters kept per user; `statistics` holds their totals and `daily_stats`
+# their per-day values.
+TOTAL_FIELDS = ("total_sessions", "total_focus", "completed_tasks")
+
+# Buffered increments are written this often, or once this many counters are waiting.
+FLUSH_INTERVAL = float(os.getenv("STATS_FLUSH_SECONDS", "5"))
+MAX_PENDING = int(os.getenv("STATS_MAX_PENDING", "1000"))
+
+
+def day_of(when: datetime) -> datetime:
+    return datetime(when.year, when.month, when.day)
+
+
+class StatsBuffer:
+    """Coalesce counter increments in memory and write them in batches.
+
+    Increments are summed per user and day and written with one unordered
+    bulk_write per collection every FLUSH_INTERVAL seconds, or as soon as
+    MAX_PENDING counters are waiting. Deltas not yet in `statistics` are
+    added to reads by `merge`.
+    """
+
+    def __init__(self, flush_interval: float = FLUSH_INTERVAL, max_pending: int = MAX_PENDING):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # user_id -> day -> field -> delta, one buffer per collection so a
+        # failed write is retried for that collection only.
+        self._totals = {}
+        self._daily = {}
+        self._in_flight = {}
+        # Written as `last_flush` by the in-flight totals writes, so `merge`
+        # can tell whether a document it was given already includes them.
+        self._flush_id = None
+        self._size = 0
+        self._flush_now = asyncio.Event()
+        self._flusher = None
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _add(buffer: dict, user_id: int, day: datetime, increments: dict) -> int:
+        counters = buffer.setdefault(user_id, {}).setdefault(day, {})
+        added = 0
+        for field, delta in increments.items():
+            if field not in counters:
+                added += 1
+            counters[field] = counters.get(field, 0) + delta
+        return added
+
+    def add(self, user_id: int, increments: dict, when: datetime = None) -> None:
+        day = day_of(when or datetime.utcnow())
+        self._size += self._add(self._totals, user_id, day, increments)
+        self._add(self._daily, user_id, day, increments)
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_periodically())
+        if self._size >= self.max_pending:
+            self._flush_now.set()
+
+    def merge(self, user_id: int, stats: dict):
+        """Add the deltas buffered for `user_id` to a `statistics` document."""
+        today = day_of(datetime.utcnow())
+        buffers = [self._totals]
+        if not stats or stats.get("last_flush") != self._flush_id:
+            buffers.insert(0, self._in_flight)
+        for buffer in buffers:
+            for day, counters in sorted(buffer.get(user_id, {}).items()):
+                stats = stats or {"user_id": user_id}
+                for field, delta in counters.items():
+                    stats[field] = stats.get(field, 0) + delta
+                if "total_sessions" in counters and day == today:
+                    if stats.get("daily_day") != today:
+                        stats["daily_sessions"] = 0
+                        stats["daily_day"] = today
+                    stats["daily_sessions"] = stats.get("daily_sessions", 0) + counters["total_sessions"]
+        return stats
+
+    @staticmethod
+    def _totals_update(user_id: int, days: dict, now: datetime, flush_id: ObjectId) -> UpdateOne:
+        totals = {}
+        for counters in days.values():
+            for field, delta in counters.items():
+                totals[field] = totals.get(field, 0) + delta
+        update = {
+            field: {"$add": [{"$ifNull": [f"${field}", 0]}, delta]}
+            for field, delta in totals.items()
+        }
+        session_days = [day for day, counters in days.items() if "total_sessions" in counters]
+        if session_days:
+            # daily_sessions restarts from zero on the first session of a new day.
+            day = max(session_days)
+            update["daily_sessions"] = {"$add": [
+                {"$cond": [{"$eq": ["$daily_day", day]}, {"$ifNull": ["$daily_sessions", 0]}, 0]},
+                days[day]["total_sessions"],
+            ]}
+            update["daily_day"] = day
+        update["last_updated"] = now
+        update["last_flush"] = flush_id
+        return UpdateOne({"user_id": user_id}, [{"$set": update}], upsert=True)
+
+    async def _write(self, collection, buffer: dict, writes: list) -> None:
+        """Run (operation, deltas) `writes`; deltas of failed operations go back into `buffer`."""
+        try:
+            await collection.bulk_write([operation for operation, _ in writes], ordered=False)
+            return
+        except BulkWriteError as error:
+            failed = [writes[write_error["index"]] for write_error in error.details["writeErrors"]]
+            logger.warning("%d of %d %s writes failed", len(failed), len(writes), collection.name)
+        except Exception:
+            # Whatever failed, the deltas are kept for the next flush.
+            failed = writes
+            logger.exception("Writing %s failed", collection.name)
+        for _, deltas in failed:
+            for user_id, day, counters in deltas:
+                added = self._add(buffer, user_id, day, counters)
+                if buffer is self._totals:
+                    self._size += added
+                    # Back in _totals, so no longer in flight.
+                    self._in_flight.pop(user_id, None)
+
+    async def flush(self) -> None:
+        async with self._lock:
+            totals, self._totals = self._totals, {}
+            daily, self._daily = self._daily, {}
+            self._size = 0
+            self._in_flight = totals
+            self._flush_id = ObjectId()
+            now = datetime.utcnow()
+            writes = []
+            if totals:
+                writes.append(self._write(stats_collection, self._totals, [
+                    (self._totals_update(user_id, days, now, self._flush_id),
+                     [(user_id, day, counters) for day, counters in days.items()])
+                    for user_id, days in totals.items()
+                ]))
+            if daily:
+                writes.append(self._write(daily_stats_collection, self._daily, [
+                    (UpdateOne({"user_id": user_id, "day": day}, {"$inc": counters}, upsert=True),
+                     [(user_id, day, counters)])
+                    for user_id, days in daily.items() for day, counters in days.items()
+                ]))
+            try:
+                await asyncio.gather(*writes)
+            finally:
+                self._in_flight = {}
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Flushing statistics failed")
+
+    async def stop(self) -> None:
+        """Stop the periodic flush and write whatever is still buffered."""
+        if self._flusher:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush()
+
+
+stats_buffer = StatsBuffer()
+
+
+async def update_stats(user_id: int, increments: dict, when: datetime = None):
+    """Add `increments` (counter -> delta) to a user's totals and to that day's bucket."""
+    stats_buffer.add(user_id, increments, when)
+
+
+async def read_stats(user_id: int):
+    stats = await stats_collection.find_one({"user_id": user_id})
+    if stats and stats.get("daily_day") != day_of(datetime.utcnow()):
+        stats["daily_sessions"] = 0
+    return stats_buffer.merge(user_id, stats)
+
+
+def archived_days(collection: str, fields: list) -> dict:
+    """A $unionWith stage adding the per-day totals kept on archive buckets.
+
+    They come out as (user_id, day, *fields) rows, like the rows the hot
+    collection is projected to before the $group.
+    """
+    return {"$unionWith": {"coll": COLLECTIONS[collection], "pipeline": [
+        {"$unwind": "$days"},
+        {"$project": {"_id": 0, "user_id": 1, "day": "$days.day", **{field: f"$days.{field}" for field in fields}}},
+    ]}}
+
+
+async def backfill():
+    """Rebuild `daily_stats` and the totals in `statistics` from history, archived history included."""
+    await daily_stats_collection.delete_many({})
+    await pomodoro_collection.aggregate([
+        {"$project": {
+            "_id": 0,
+            "user_id": 1,
+            "day": {"$dateTrunc": {"date": "$start_time", "unit": "day"}},
+            "total_sessions": {"$ifNull": ["$sessions_completed", 0]},
+            "total_focus": {"$ifNull": [
+                "$focus_minutes",
+                {"$multiply": [{"$ifNull": ["$sessions_completed", 0]}, {"$ifNull": ["$work_duration", 0]}]},
+            ]},
+        }},
+        archived_days("pomodoro_sessions_archive", ["total_sessions", "total_focus"]),
+        {"$group": {
+            "_id": {"user_id": "$user_id", "day": "$day"},
+            "total_sessions": {"$sum": "$total_sessions"},
+            "total_focus": {"$sum": "$total_focus"},
+        }},
+        {"$project": {
+            "_id": 0,
+            "user_id": "$_id.user_id",
+            "day": "$_id.day",
+            "total_sessions": 1,
+            "total_focus": 1,
+        }},
+        {"$merge": {"into": COLLECTIONS["daily_stats"], "on": ["user_id", "day"], "whenMatched": "merge"}},
+    ])
+    await tasks_collection.aggregate([
+        {"$match": {"status": "completed"}},
+        {"$project": {
+            "_id": 0,
+            "user_id": 1,
+            # Tasks completed before completed_at was recorded count on their due date.
+            "day": {"$dateTrunc": {"date": {"$ifNull": ["$completed_at", "$due_date"]}, "unit": "day"}},
+            "completed_tasks": {"$literal": 1},
+        }},
+        archived_days("tasks_archive", ["completed_tasks"]),
+        {"$group": {
+            "_id": {"user_id": "$user_id", "day": "$day"},
+            "completed_tasks": {"$sum": "$completed_tasks"},
+        }},
+        {"$project": {"_id": 0, "user_id": "$_id.user_id", "day": "$_id.day", "completed_tasks": 1}},
+        {"$merge": {"into": COLLECTIONS["daily_stats"], "on": ["user_id", "day"], "whenMatched": "merge"}},
+    ])
+
+    today = day_of(datetime.utcnow())
+    await daily_stats_collection.aggregate([
+        {"$group": {
+            "_id": "$user_id",
+            **{field: {"$sum": {"$ifNull": [f"${field}", 0]}} for field in TOTAL_FIELDS},
+            "daily_sessions": {"$sum": {"$cond": [{"$eq": ["$day", today]}, "$total_sessions", 0]}},
+        }},
+        {"$set": {"user_id": "$_id", "daily_day": today, "last_updated": "$$NOW"}},
+        {"$unset": "_id"},
+        {"$merge": {"into": COLLECTIONS["statistics"], "on": "user_id", "whenMatched": "merge"}},
+    ])
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["backfill"]:
+        sys.exit("usage: python stats.py backfill")
+    asyncio.run(backfill())
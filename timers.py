@@ -0,0 +1,325 @@
+import asyncio
+import logging
+import math
+import os
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from cluster import partition_filter, partition_of
+from countdown import CountdownEditor
+from db import pomodoro_collection, tasks_collection, timers_collection
+from metrics import Gauge
+from report import report_cache
+from scheduler import DeadlineScheduler
+from stats import update_stats
+
+logger = logging.getLogger(__name__)
+
+WORK = "work"
+BREAK = "break"
+DONE = "done"
+
+# Length of a Pomodoro "minute"; the load test shrinks it to run whole sessions quickly.
+MINUTE = timedelta(seconds=float(os.getenv("POMODORO_MINUTE_SECONDS", "60")))
+
+ACTIVE_SESSIONS = Gauge("pomodoro_active_sessions", "Pomodoro sessions tracked by this worker.")
+
+
+def stored_time(value):
+    """`value` as Mongo stores it: datetimes keep whole milliseconds only."""
+    if value is None:
+        return None
+    return value.replace(microsecond=value.microsecond // 1000 * 1000)
+
+
+class PomodoroTimers(DeadlineScheduler):
+    """Drive every user's Pomodoro phases from one deadline heap.
+
+    A session is a small document in `pomodoro_timers` holding its phase and
+    the deadline of that phase; `sessions` mirrors those documents in memory.
+    There is no task per user, and sessions survive restarts: `run` reloads
+    them and transitions that came due while the bot was down are caught up.
+    Each phase ends at the previous phase's deadline plus its length, never
+    at "when the last message went out" plus its length, so send latency
+    does not add up over a session. Each session's status message counts
+    down the phase, kept current by `countdown`.
+    """
+
+    def __init__(self):
+        super().__init__("pomodoro")
+        self.sessions = {}
+        # False while `recover` is still loading sessions; `get` asks Mongo until then.
+        self.recovered = True
+        self._bot = None
+        self.countdown = CountdownEditor(self.sessions, self.status_text)
+        ACTIVE_SESSIONS.track(self.sessions.__len__)
+
+    async def begin(self, user_id: int, chat_id: int, task_id: str, num_sessions: int,
+                    work_time: int, break_time: int, task_ids: list = None) -> dict:
+        """Start a session on `task_id`, or on all of `task_ids` (from /select) if given."""
+        # Truncated so the in-memory deadlines equal the ones read back from Mongo.
+        now = stored_time(datetime.utcnow())
+        session_data = {
+            "_id": user_id,
+            "user_id": user_id,
+            "chat_id": chat_id,
+            "task_id": task_id,
+            "start_time": now,
+            "work_time": work_time,
+            "break_time": break_time,
+            "num_sessions": num_sessions,
+            "sessions_completed": 0,
+            "session": 0,
+            "phase": WORK,
+            "phase_deadline": now + work_time * MINUTE,
+        }
+        if task_ids:
+            session_data["task_ids"] = task_ids
+        text = self.status_text(session_data, now)
+        message = await self._bot.send_message(chat_id=chat_id, text=text)
+        session_data["status_message_id"] = message.message_id
+        await timers_collection.replace_one({"_id": user_id}, session_data, upsert=True)
+        self.countdown.shown(session_data, text)
+        self.sync(session_data)
+        return session_data
+
+    async def get(self, user_id: int):
+        """Return a user's session, asking Mongo if another worker runs it or recovery is running."""
+        if self.owns(user_id) and self.recovered:
+            return self.sessions.get(user_id)
+        return await timers_collection.find_one({"_id": user_id})
+
+    async def end(self, user_id: int):
+        """Forget a user's session, whatever phase it is in."""
+        self.forget(user_id)
+        return await timers_collection.find_one_and_delete({"_id": user_id})
+
+    def sync(self, session_data: dict) -> None:
+        """Track a session document written here or by another worker."""
+        user_id = session_data["user_id"]
+        if not self.owns(user_id):
+            return
+        self.sessions[user_id] = session_data
+        if session_data["phase"] == DONE:
+            self.cancel(user_id)
+        else:
+            self.schedule(user_id, session_data["phase_deadline"])
+
+    def forget(self, user_id: int) -> None:
+        self.cancel(user_id)
+        self.sessions.pop(user_id, None)
+
+    async def on_change(self, change: dict) -> None:
+        """Apply a change made to `pomodoro_timers` by another worker."""
+        if change["operationType"] == "delete":
+            self.forget(change["documentKey"]["_id"])
+        elif change.get("fullDocument"):
+            self.sync(change["fullDocument"])
+
+    @staticmethod
+    def advance(session_data: dict) -> list:
+        """Move a session into its next phase and return the messages to send."""
+        if session_data["phase"] == WORK:
+            session_data["sessions_completed"] += 1
+            if session_data["session"] < session_data["num_sessions"] - 1:
+                session_data["phase"] = BREAK
+                session_data["phase_deadline"] += session_data["break_time"] * MINUTE
+                return [f"⏰ Break time! ({session_data['break_time']} minutes)"]
+            session_data["phase"] = DONE
+            session_data["phase_deadline"] = None
+            return ["🎉 All sessions completed!"]
+
+        session_data["session"] += 1
+        session_data["phase"] = WORK
+        session_data["phase_deadline"] += session_data["work_time"] * MINUTE
+        return [
+            "Back to work! 💪",
+            f"Session {session_data['session'] + 1}/{session_data['num_sessions']} started! 🎯",
+        ]
+
+    async def fire(self, keys: list) -> None:
+        now = datetime.utcnow()
+        # Marks this batch's writes, so they can be told apart from another
+        # worker's write of the same transition.
+        claim = ObjectId()
+        writes = []
+        advanced = {}
+        for user_id in keys:
+            session_data = self.sessions.get(user_id)
+            if not session_data or session_data["phase"] == DONE:
+                continue
+            previous_deadline = session_data["phase_deadline"]
+            completed_before = session_data["sessions_completed"]
+            messages = self.advance(session_data)
+            # Catch up on phases that elapsed while the bot was down; only the
+            # phase the session ends up in is announced.
+            while session_data["phase"] != DONE and session_data["phase_deadline"] <= now:
+                messages = self.advance(session_data)
+
+            writes.append(UpdateOne(
+                {"_id": user_id, "phase_deadline": previous_deadline},
+                {"$set": {
+                    "phase": session_data["phase"],
+                    "phase_deadline": session_data["phase_deadline"],
+                    "session": session_data["session"],
+                    "sessions_completed": session_data["sessions_completed"],
+                    "claim": claim,
+                }},
+            ))
+            advanced[user_id] = (session_data, messages, session_data["sessions_completed"] - completed_before)
+            if session_data["phase"] != DONE:
+                self.schedule(user_id, session_data["phase_deadline"])
+
+        if not writes:
+            return
+        result = await timers_collection.bulk_write(writes, ordered=False)
+        if result.matched_count < len(writes):
+            # Some sessions were stopped or moved on by someone else while we
+            # were advancing them; only announce the transitions that stuck.
+            persisted = {
+                doc["_id"]: doc
+                async for doc in timers_collection.find({"_id": {"$in": list(advanced)}})
+            }
+            for user_id, (session_data, _, _) in list(advanced.items()):
+                doc = persisted.get(user_id)
+                if doc and doc.get("claim") == claim:
+                    continue
+                del advanced[user_id]
+                if self.sessions.get(user_id) is session_data:
+                    if doc:
+                        self.sync(doc)
+                    else:
+                        self.forget(user_id)
+
+        # Skip sessions stopped while the write was in flight.
+        advanced = {
+            user_id: entry for user_id, entry in advanced.items()
+            if self.sessions.get(user_id) is entry[0]
+        }
+        await asyncio.gather(
+            *(
+                self._send(session_data["chat_id"], messages)
+                for session_data, messages, _ in advanced.values()
+            ),
+            *(
+                update_stats(session_data["user_id"], {
+                    "total_sessions": completed,
+                    "total_focus": completed * session_data["work_time"],
+                })
+                for session_data, _, completed in advanced.values() if completed
+            ),
+        )
+        finished = [
+            session_data for session_data, _, _ in advanced.values() if session_data["phase"] == DONE
+        ]
+        if finished:
+            await pomodoro_collection.insert_many([
+                self.history_record(session_data, completed=True) for session_data in finished
+            ])
+            for session_data in finished:
+                report_cache.bump(session_data["user_id"])
+            await self.ask_task_completion(finished)
+
+    @staticmethod
+    def status_text(session_data: dict, now: datetime) -> str:
+        """The text of a session's live status message."""
+        number = f"{session_data['session'] + 1}/{session_data['num_sessions']}"
+        if session_data["phase"] == DONE:
+            return f"🎉 All {session_data['num_sessions']} sessions completed!"
+        label = f"Session {number}: focus 🎯" if session_data["phase"] == WORK else f"Session {number}: break ☕"
+        # Whole minutes, so the text (and the message) changes at most once a minute.
+        left = max(0, math.ceil((session_data["phase_deadline"] - now) / MINUTE))
+        return f"{label}\n⏳ {left} min left"
+
+    @staticmethod
+    def partial_focus(session_data: dict, now: datetime) -> int:
+        """Whole minutes already worked in an unfinished work phase."""
+        if session_data["phase"] != WORK:
+            return 0
+        remaining = (session_data["phase_deadline"] - now) / MINUTE
+        return max(0, int(session_data["work_time"] - remaining))
+
+    @staticmethod
+    def history_record(session_data: dict, completed: bool, partial_focus: int = 0) -> dict:
+        """The pomodoro_sessions entry written when a session finishes or is stopped."""
+        record = {
+            "user_id": session_data["user_id"],
+            "task_id": ObjectId(session_data["task_id"]),
+            "start_time": session_data["start_time"],
+            "end_time": datetime.utcnow(),
+            "work_duration": session_data["work_time"],
+            "break_duration": session_data["break_time"],
+            "sessions_completed": session_data["sessions_completed"],
+            "total_sessions": session_data["num_sessions"],
+            "focus_minutes": session_data["sessions_completed"] * session_data["work_time"] + partial_focus,
+            "completed": completed
+        }
+        if session_data.get("task_ids"):
+            record["task_ids"] = [ObjectId(task_id) for task_id in session_data["task_ids"]]
+        return record
+
+    async def _send(self, chat_id: int, messages: list):
+        for text in messages:
+            await self._bot.send_message(chat_id=chat_id, text=text)
+
+    async def ask_task_completion(self, finished: list):
+        task_ids = [
+            ObjectId(task_id)
+            for session_data in finished
+            for task_id in session_data.get("task_ids") or [session_data["task_id"]]
+        ]
+        titles = {
+            str(task["_id"]): task["title"]
+            async for task in tasks_collection.find({"_id": {"$in": task_ids}}, {"title": 1})
+        }
+        keyboard = [
+            [InlineKeyboardButton("Yes", callback_data="task_done_yes"),
+             InlineKeyboardButton("No", callback_data="task_done_no")]
+        ]
+
+
+        def question(session_data: dict) -> str:
+            if not session_data.get("task_ids"):
+                return f"Did you complete the task: {titles.get(session_data['task_id'], 'Unknown task')}?"
+            names = ", ".join(titles.get(task_id, "Unknown task") for task_id in session_data["task_ids"])
+            return f"Did you complete the tasks: {names}?"
+
+        await asyncio.gather(*(
+            self._bot.send_message(
+                chat_id=session_data["chat_id"],
+                text=question(session_data),
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+            for session_data in finished
+        ))
+
+    async def recover(self, partitions=None):
+        """Reload persisted sessions; overdue ones fire as soon as `run` starts."""
+        query = {} if partitions is None else partition_filter(partitions)
+        recovered = 0
+        async for session_data in timers_collection.find(query):
+            self.sync(session_data)
+            recovered += 1
+        logger.info("Recovered %d Pomodoro sessions", recovered)
+
+    async def add_partitions(self, partitions: set) -> None:
+        self.partitions = (self.partitions or set()) | partitions
+        await self.recover(partitions)
+
+    def drop_partitions(self, partitions: set) -> None:
+        self.partitions = (self.partitions or set()) - partitions
+        for user_id in list(self.sessions):
+            if partition_of(user_id) in partitions:
+                self.forget(user_id)
+
+    def start(self, bot) -> None:
+        self._bot = bot
+        super().start()
+        self.countdown.start(bot)
+
+    async def stop(self) -> None:
+        await self.countdown.stop()
+        await super().stop()
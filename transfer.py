@@ -0,0 +1,203 @@
+"""Bulk task import and export.
+
+Imports accept CSV (a header row naming the columns) or JSON, either an array
+of objects or one object per line. Files are parsed a record at a time from
+disk and inserted IMPORT_CHUNK tasks per insert_many, so their size is bounded
+only by Telegram's download limit. Exports are written as NDJSON: one task or
+Pomodoro session per line, streamed from Mongo into a file. The task lines of
+an export can be imported again.
+"""
+import csv
+import json
+import os
+from datetime import datetime, timezone
+
+from bson.objectid import ObjectId
+
+from archive import iter_archived
+from db import pomodoro_collection, tasks_collection
+from recurrence import format_rule, parse_recurrence
+
+IMPORT_CHUNK = 500
+# Bots can only download files up to 20 MB.
+MAX_IMPORT_BYTES = 20 * 1024 * 1024
+MAX_TITLE = 256
+MAX_DESCRIPTION = 4000
+# Rejected rows reported back to the user; the rest are only counted.
+MAX_REPORTED_ERRORS = 10
+
+TASK_FIELDS = ("title", "description", "due_date", "status", "created_at", "completed_at", "recurrence")
+SESSION_FIELDS = (
+    "task_id", "start_time", "end_time", "work_duration", "break_duration",
+    "sessions_completed", "total_sessions", "focus_minutes", "completed",
+)
+
+
+def file_format(file_name: str, mime_type: str = None):
+    """Return "csv" or "json" for an uploaded file, or None if it is neither."""
+    extension = os.path.splitext(file_name or "")[1].lower()
+    if extension == ".csv" or mime_type in ("text/csv", "text/comma-separated-values"):
+        return "csv"
+    if extension in (".json", ".ndjson", ".jsonl") or mime_type == "application/json":
+        return "json"
+    return None
+
+
+def iter_json(file, chunk_size: int = 64 * 1024):
+    """Yield the objects of a JSON array or of newline-delimited JSON one by one."""
+    decoder = json.JSONDecoder()
+    buffer = file.read(chunk_size).lstrip()
+    if buffer.startswith("["):
+        buffer = buffer[1:]
+    while True:
+        buffer = buffer.lstrip().lstrip(",").lstrip()
+        if buffer.startswith("]"):
+            return
+        try:
+            if not buffer:
+                raise ValueError
+            record, end = decoder.raw_decode(buffer)
+        except ValueError:
+            # Empty buffer, or a record cut off at the end of the chunk.
+            chunk = file.read(chunk_size)
+            if not chunk:
+                if buffer:
+                    raise
+                return
+            buffer += chunk
+            continue
+        yield record
+        buffer = buffer[end:]
+
+
+def parse_datetime(value, field: str):
+    if isinstance(value, datetime):
+        return value
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError(f"{field} is missing")
+    try:
+        parsed = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    except ValueError:
+        raise ValueError(f"{field} must look like YYYY-MM-DD") from None
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def task_from_record(record, user_id: int, now: datetime) -> dict:
+    """Validate one imported record and turn it into a task document."""
+    if not isinstance(record, dict):
+        raise ValueError("expected an object with title and due_date")
+    title = str(record.get("title") or "").strip()
+    if not title:
+        raise ValueError("title is missing")
+    if len(title) > MAX_TITLE:
+        raise ValueError(f"title is longer than {MAX_TITLE} characters")
+    description = str(record.get("description") or "")
+    if len(description) > MAX_DESCRIPTION:
+        raise ValueError(f"description is longer than {MAX_DESCRIPTION} characters")
+    status = str(record.get("status") or "pending").strip().lower()
+    if status not in ("pending", "completed"):
+        raise ValueError("status must be pending or completed")
+
+    task = {
+        "user_id": user_id,
+        "title": title,
+        "description": description,
+        "due_date": parse_datetime(record.get("due_date"), "due_date"),
+        "status": status,
+        "created_at": now,
+    }
+    recurrence = str(record.get("recurrence") or "").strip()
+    if recurrence:
+        task["recurrence"] = format_rule(parse_recurrence(recurrence))
+    if status == "completed":
+        completed_at = record.get("completed_at")
+        task["completed_at"] = parse_datetime(completed_at, "completed_at") if completed_at else now
+    return task
+
+
+def iter_records(path: str, fmt: str):
+    """Yield (row number, record) from an uploaded file."""
+    with open(path, newline="", encoding="utf-8-sig") as file:
+        if fmt == "csv":
+            # Row 1 is the header.
+            yield from enumerate(csv.DictReader(file), start=2)
+        else:
+            yield from enumerate(iter_json(file), start=1)
+
+
+async def import_tasks(user_id: int, path: str, fmt: str, on_inserted=None) -> dict:
+    """Insert the valid tasks of an uploaded file.
+
+    `on_inserted(task)` is called for every inserted task, once its chunk is
+    written. Returns the counts of imported and completed tasks and the
+    rejected rows as (row, reason).
+    """
+    now = datetime.utcnow()
+    result = {"imported": 0, "completed": 0, "rejected": 0, "errors": []}
+    chunk = []
+
+    async def flush():
+        await tasks_collection.insert_many(chunk, ordered=False)
+        result["imported"] += len(chunk)
+        result["completed"] += sum(task["status"] == "completed" for task in chunk)
+        if on_inserted:
+            for task in chunk:
+                on_inserted(task)
+        chunk.clear()
+
+    try:
+        for row, record in iter_records(path, fmt):
+            # Lines written by /export for Pomodoro sessions are not tasks.
+            if isinstance(record, dict) and record.get("type", "task") != "task":
+                continue
+            try:
+                chunk.append(task_from_record(record, user_id, now))
+            except ValueError as error:
+                result["rejected"] += 1
+                if len(result["errors"]) < MAX_REPORTED_ERRORS:
+                    result["errors"].append((row, str(error)))
+                continue
+            if len(chunk) >= IMPORT_CHUNK:
+                await flush()
+    except (ValueError, UnicodeDecodeError, csv.Error) as error:
+        # The file itself is malformed; keep what was read before the error.
+        result["errors"].append((None, f"could not read the rest of the file ({error})"))
+    if chunk:
+        await flush()
+    return result
+
+
+def export_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def export_line(doc: dict, kind: str, fields: tuple) -> str:
+    record = {field: doc[field] for field in fields if field in doc}
+    record["type"] = kind
+    record["id"] = doc["_id"]
+    return json.dumps(record, default=export_default, ensure_ascii=False) + "\n"
+
+
+async def export_tasks(user_id: int, path: str) -> dict:
+    """Write a user's tasks and Pomodoro history, archived ones included, to `path` as NDJSON."""
+    counts = {"tasks": 0, "sessions": 0}
+    sources = (
+        ("tasks", "task", TASK_FIELDS, tasks_collection),
+        ("sessions", "pomodoro_session", SESSION_FIELDS, pomodoro_collection),
+    )
+    with open(path, "w", encoding="utf-8") as file:
+        for kind, record_type, fields, collection in sources:
+            projection = {field: 1 for field in fields}
+            async for doc in collection.find({"user_id": user_id}, projection, batch_size=1000):
+                file.write(export_line(doc, record_type, fields))
+                counts[kind] += 1
+            async for doc in iter_archived(kind, user_id):
+                file.write(export_line(doc, record_type, fields))
+                counts[kind] += 1
+    return counts